@@ -0,0 +1,330 @@
+"""Anthropic plumbing shared by the examples: converting sessions to API
+messages and back, squeezing long histories, prompt-cache breakpoints, and an
+`invoke_model` that streams responses through the response cache.
+
+The client, the model-call semaphore and the response cache live here so every
+subagent in a process shares them.
+"""
+import anthropic
+import asyncio
+import functools
+import itertools
+import orjson
+import os
+from collections import OrderedDict
+from dotenv import load_dotenv
+from llm_cache import LLMCache, cache_key
+import simple_agent_loop as sal
+
+load_dotenv()
+
+# Retry rate-limited and overloaded requests with exponential backoff.
+client = anthropic.AsyncAnthropic(max_retries=5)
+
+# Bounds concurrent model calls across the coordinator and all of its subagents,
+# so nested fan-out can't multiply past the API rate limit.
+model_calls = asyncio.Semaphore(int(os.environ.get("AGENT_MAX_MODEL_CALLS", "10")))
+
+# Set LLM_CACHE_PATH to also persist cached responses across runs.
+llm_cache = LLMCache(path=os.environ.get("LLM_CACHE_PATH"))
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Above this many (estimated) input tokens, older turns are squeezed before sending.
+HISTORY_TOKEN_LIMIT = int(os.environ.get("AGENT_HISTORY_TOKEN_LIMIT", "20000"))
+# Once squeezing, the squeezed part only grows after this many more tokens.
+HISTORY_SQUEEZE_STEP = HISTORY_TOKEN_LIMIT // 4
+
+
+# Messages parsed from a response keep the API block they came from in "_block".
+# It is sent back as-is unless compaction has since replaced the message's payload.
+
+def _text_block(msg):
+    block = msg.get("_block")
+    if block is not None and block["text"] is msg["content"]:
+        return block
+    return {"type": "text", "text": msg["content"]}
+
+
+def _thinking_block(msg):
+    block = msg.get("_block")
+    if block is not None and block["thinking"] is msg["content"]:
+        return block
+    block = {"type": "thinking", "thinking": msg["content"]}
+    if "signature" in msg:
+        block["signature"] = msg["signature"]
+    return block
+
+
+def _tool_use_block(msg):
+    block = msg.get("_block")
+    if block is not None and block["input"] is msg["input"]:
+        return block
+    return {
+        "type": "tool_use", "id": msg["id"],
+        "name": msg["name"], "input": msg["input"],
+    }
+
+
+def _tool_result_block(msg):
+    output = msg["output"]
+    return {
+        "type": "tool_result", "tool_use_id": msg["id"],
+        "content": output if isinstance(output, str) else orjson.dumps(output).decode(),
+    }
+
+
+def _chars(content):
+    return len(orjson.dumps(content))
+
+
+def _flush(cache, key, role):
+    if cache[key]:
+        cache["api_messages"].append({"role": role, "content": cache[key]})
+        cache[key] = []
+
+
+# (role, type) -> (group, block builder). Consecutive messages of the same group
+# become one API message (or, for "user", one API message each).
+_MESSAGE_KINDS = {
+    ("system", None): ("system", None),
+    ("user", None): ("user", None),
+    ("assistant", None): ("assistant", _text_block),
+    (None, "thinking"): ("assistant", _thinking_block),
+    (None, "tool_call"): ("assistant", _tool_use_block),
+    (None, "tool_result"): ("tool_result", _tool_result_block),
+}
+_UNKNOWN_KIND = (None, None)
+
+# Block groups: the open list they extend in the cache, and the group they close.
+_BLOCK_GROUPS = {
+    "assistant": ("assistant_blocks", ("tool_result_blocks", "user")),
+    "tool_result": ("tool_result_blocks", ("assistant_blocks", "assistant")),
+}
+
+
+def _kind(msg):
+    return _MESSAGE_KINDS.get((msg.get("role"), msg.get("type")), _UNKNOWN_KIND)
+
+
+def to_api_block(msg):
+    """Convert one assistant, thinking, tool_call or tool_result message to an API content block."""
+    make_block = _kind(msg)[1]
+    return make_block(msg) if make_block else None
+
+
+def to_api_messages(session):
+    """Convert generic messages to Anthropic API format. Returns (system_prompt, api_messages).
+
+    Sessions are append-only, so the conversion is cached in session["_api_cache"]
+    and each call only translates the messages appended since the previous one.
+    Blocks of messages that compact_session rewrote in place are rebuilt.
+    The cache also keeps a running count of the serialized content's length in
+    "chars", so the history's size is known without re-serializing it.
+    """
+    messages = session["messages"]
+    compacted = session.get("_compacted", [])
+    cache = session.get("_api_cache")
+    if cache is None:
+        cache = session["_api_cache"] = {
+            "len": 0, "compacted": len(compacted), "system": None, "api_messages": [], "chars": 0,
+            "blocks": [], "assistant_blocks": [], "tool_result_blocks": [],
+        }
+
+    # Blocks can be shared with the response cache or a forked session, so
+    # compacted ones are replaced rather than updated in place.
+    for i in compacted[cache["compacted"]:]:
+        if i < cache["len"] and cache["blocks"][i] is not None:
+            blocks, j = cache["blocks"][i]
+            block = to_api_block(messages[i])
+            cache["chars"] += _chars(block) - _chars(blocks[j])
+            blocks[j] = block
+    cache["compacted"] = len(compacted)
+
+    # Convert the new messages one run of same-group messages at a time. The
+    # cache records each message's block location as (list, index); a group
+    # list becomes its API message's content when flushed, so that stays valid.
+    tail = [(msg, _kind(msg)) for msg in messages[cache["len"]:]]
+    for group, run in itertools.groupby(tail, key=lambda item: item[1][0]):
+        run = list(run)
+        if group in _BLOCK_GROUPS:
+            key, (other_key, other_role) = _BLOCK_GROUPS[group]
+            _flush(cache, other_key, other_role)
+            target = cache[key]
+            start = len(target)
+            target.extend([make_block(msg) for msg, (_, make_block) in run])
+            cache["chars"] += sum(_chars(block) for block in target[start:])
+            cache["blocks"].extend([(target, j) for j in range(start, len(target))])
+            continue
+        if group == "system":
+            cache["system"] = run[-1][0]["content"]
+        elif group == "user":
+            _flush(cache, "assistant_blocks", "assistant")
+            _flush(cache, "tool_result_blocks", "user")
+            cache["api_messages"].extend([{"role": "user", "content": msg["content"]} for msg, _ in run])
+            cache["chars"] += sum(_chars(msg["content"]) for msg, _ in run)
+        cache["blocks"].extend([None] * len(run))
+    cache["len"] = len(messages)
+
+    # An open block group may still be extended by the next call, so it stays
+    # in the cache and is only closed off in the returned copy.
+    api_messages = list(cache["api_messages"])
+    if cache["assistant_blocks"]:
+        api_messages.append({"role": "assistant", "content": list(cache["assistant_blocks"])})
+    if cache["tool_result_blocks"]:
+        api_messages.append({"role": "user", "content": list(cache["tool_result_blocks"])})
+    return cache["system"], api_messages
+
+
+def from_api_block(block):
+    """Convert one API content block back to a generic message (None for empty text)."""
+    if block["type"] == "thinking":
+        msg = {"type": "thinking", "content": block["thinking"], "ts": sal.now(), "_block": block}
+        if "signature" in block:
+            msg["signature"] = block["signature"]
+        return msg
+    if block["type"] == "text" and block["text"]:
+        return {"role": "assistant", "content": block["text"], "ts": sal.now(), "_block": block}
+    if block["type"] == "tool_use":
+        return {
+            "type": "tool_call", "name": block["name"],
+            "id": block["id"], "input": block["input"], "_block": block,
+        }
+    return None
+
+
+_STOPWORDS = frozenset(
+    "a an the of to in on at for and or but is are was were be been being that this "
+    "these those it its as by with from".split()
+)
+
+
+def _squeeze(text):
+    # Empty text blocks are rejected by the API, so all-stopword text is kept.
+    return " ".join(word for word in text.split() if word.lower() not in _STOPWORDS) or text
+
+
+def _squeeze_block(block):
+    if block["type"] == "text":
+        return {**block, "text": _squeeze(block["text"])}
+    if block["type"] == "tool_result" and isinstance(block["content"], str):
+        return {**block, "content": _squeeze(block["content"])}
+    return block  # thinking must be sent back verbatim, tool_use input is structured
+
+
+def compress_history(api_messages, upto):
+    """Squeeze the text of older turns: collapse whitespace and drop stopwords.
+
+    Only api_messages[1:upto] are squeezed; the first message (the task) and
+    everything from upto on are sent as is. Returns a new list; the messages
+    passed in are not modified.
+    """
+    middle = api_messages[1:upto]
+    squeezed = [
+        {**m, "content": _squeeze(m["content"]) if isinstance(m["content"], str)
+         else [_squeeze_block(b) for b in m["content"]]}
+        for m in middle
+    ]
+    return api_messages[:1] + squeezed + api_messages[1 + len(middle):]
+
+
+def _with_cache_control(message):
+    """Copy an API message with a cache breakpoint on its last content block.
+    Thinking blocks can't carry one, so a message ending in thinking is left as is."""
+    content = message["content"]
+    if not content or (isinstance(content, list) and content[-1]["type"] == "thinking"):
+        return message
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    return {**message, "content": content[:-1] + [{**content[-1], "cache_control": CACHE_CONTROL}]}
+
+
+# The system prompt and tool schemas are the same on every call, so their
+# cache-marked API form and a digest of it (standing in for them in response
+# cache keys) are built once rather than on each request.
+
+@functools.lru_cache(maxsize=64)
+def _static_system(system_prompt):
+    system = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+    return system, cache_key(system=system)
+
+
+# Tool lists aren't hashable, so they are looked up by identity. Each entry
+# holds its list so the id can't be reused; like _static_system, only the 64
+# most recently used are kept.
+_static_tool_lists = OrderedDict()  # id(tools) -> (tools, marked tools, digest)
+
+
+def _static_tools(tools):
+    entry = _static_tool_lists.get(id(tools))
+    if entry is None or entry[0] is not tools:
+        marked = tools[:-1] + [{**tools[-1], "cache_control": CACHE_CONTROL}]
+        entry = _static_tool_lists[id(tools)] = (tools, marked, cache_key(tools=marked))
+        if len(_static_tool_lists) > 64:
+            _static_tool_lists.popitem(last=False)
+    _static_tool_lists.move_to_end(id(tools))
+    return entry[1], entry[2]
+
+
+async def invoke_model(tools, session, model="claude-sonnet-4-5", thinking=None, max_tokens=16000):
+    """Call the model with the session. Bind model, max_tokens (and, for extended
+    thinking, a thinking config such as {"type": "enabled", "budget_tokens": 10000})
+    with functools.partial to give a subagent a different setup."""
+    system_prompt, api_messages = to_api_messages(session)
+    # Squeeze up to a point that only moves in steps of HISTORY_SQUEEZE_STEP
+    # tokens (at ~4 characters per token), so consecutive requests still share
+    # a prefix and read the history the previous one cached. The two latest
+    # messages are left verbatim when the point moves.
+    cache = session["_api_cache"]
+    squeezed_upto, squeezed_at = cache.get("squeezed", (0, 0))
+    if cache["chars"] // 4 > HISTORY_TOKEN_LIMIT and (cache["chars"] - squeezed_at) // 4 > HISTORY_SQUEEZE_STEP:
+        squeezed_upto, squeezed_at = cache["squeezed"] = (len(api_messages) - 2, cache["chars"])
+    if squeezed_upto > 1:
+        api_messages = compress_history(api_messages, squeezed_upto)
+
+    # Call the model
+    kwargs = dict(model=model, max_tokens=max_tokens, messages=api_messages)
+    # Sample greedily so repeated requests can reuse a cached response. Extended
+    # thinking requires the default temperature (1.0), so it is left unset then.
+    if thinking is not None:
+        kwargs["thinking"] = thinking
+    else:
+        kwargs["temperature"] = 0
+    # Mark the static prefix (system prompt, then tool schemas) as cacheable so
+    # repeat calls only pay prefill for the messages that follow it.
+    static_digests = {}
+    if system_prompt:
+        kwargs["system"], static_digests["system"] = _static_system(system_prompt)
+    if tools:
+        kwargs["tools"], static_digests["tools"] = _static_tools(tools)
+    # Then the first user message, which is the same for the whole session, and
+    # the last message, so each call reads the history the previous call cached.
+    # A lone user message without tools is a one-shot call with no later turn to
+    # read it (exact repeats hit the response cache), so it isn't marked.
+    # The cached conversion is shared, so these are marked on copies.
+    if len(api_messages) > 1 or (api_messages and tools):
+        api_messages[0] = _with_cache_control(api_messages[0])
+    if len(api_messages) > 1:
+        api_messages[-1] = _with_cache_control(api_messages[-1])
+    # Responses are only reused when sampling is greedy.
+    cacheable = kwargs.get("temperature") == 0
+    key = cache_key(**{**kwargs, **static_digests}) if cacheable else None
+    api_response = llm_cache.get(key) if cacheable else None
+    if api_response is not None:
+        for block in api_response.get("content", []):
+            msg = from_api_block(block)
+            if msg is not None:
+                yield msg
+        return
+
+    # Stream the response and yield each block as soon as it is complete, so the
+    # agent loop can start a tool call while later blocks are still being generated.
+    async with model_calls, client.messages.stream(**kwargs) as stream:
+        async for event in stream:
+            if event.type == "content_block_stop":
+                msg = from_api_block(event.content_block.to_dict())
+                if msg is not None:
+                    yield msg
+        api_response = (await stream.get_final_message()).to_dict()
+    if cacheable:
+        llm_cache.put(key, api_response)
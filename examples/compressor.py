@@ -1,129 +1,91 @@
-import anthropic
-import json
-from dotenv import load_dotenv
+import asyncio
+import functools
+import orjson
+import os
+from anthropic_model import client, invoke_model, llm_cache
+from llm_cache import NearDuplicateCache, memoize
 import simple_agent_loop as sal
-from simple_agent_loop import init_session, agent_loop, response
-
-load_dotenv()
-
-client = anthropic.Anthropic()
-
-
-def invoke_model(tools, session):
-    # Convert generic messages to Anthropic API format
-    system_prompt = None
-    api_messages = []
-    assistant_blocks = []
-    tool_result_blocks = []
-
-    def flush_assistant():
-        nonlocal assistant_blocks
-        if assistant_blocks:
-            api_messages.append({"role": "assistant", "content": assistant_blocks})
-            assistant_blocks = []
-
-    def flush_tool_results():
-        nonlocal tool_result_blocks
-        if tool_result_blocks:
-            api_messages.append({"role": "user", "content": tool_result_blocks})
-            tool_result_blocks = []
-
-    for msg in session["messages"]:
-        role = msg.get("role")
-        msg_type = msg.get("type")
-        if role == "system":
-            system_prompt = msg["content"]
-        elif role == "user":
-            flush_assistant()
-            flush_tool_results()
-            api_messages.append({"role": "user", "content": msg["content"]})
-        elif role == "assistant":
-            flush_tool_results()
-            assistant_blocks.append({"type": "text", "text": msg["content"]})
-        elif msg_type == "thinking":
-            flush_tool_results()
-            block = {"type": "thinking", "thinking": msg["content"]}
-            if "signature" in msg:
-                block["signature"] = msg["signature"]
-            assistant_blocks.append(block)
-        elif msg_type == "tool_call":
-            flush_tool_results()
-            assistant_blocks.append({
-                "type": "tool_use", "id": msg["id"],
-                "name": msg["name"], "input": msg["input"],
-            })
-        elif msg_type == "tool_result":
-            flush_assistant()
-            output = msg["output"]
-            tool_result_blocks.append({
-                "type": "tool_result", "tool_use_id": msg["id"],
-                "content": output if isinstance(output, str) else json.dumps(output),
-            })
-    flush_assistant()
-    flush_tool_results()
-
-    # Call the model
-    kwargs = dict(model="claude-sonnet-4-5", max_tokens=16000, messages=api_messages)
-    if system_prompt:
-        kwargs["system"] = system_prompt
-    if tools:
-        kwargs["tools"] = tools
-    api_response = client.messages.create(**kwargs).to_dict()
-
-    # Parse response back to generic messages
-    messages = []
-    for block in api_response.get("content", []):
-        if block["type"] == "thinking":
-            msg = {"type": "thinking", "content": block["thinking"], "ts": sal.now()}
-            if "signature" in block:
-                msg["signature"] = block["signature"]
-            messages.append(msg)
-        elif block["type"] == "text" and block["text"]:
-            messages.append({"role": "assistant", "content": block["text"], "ts": sal.now()})
-        elif block["type"] == "tool_use":
-            messages.append({
-                "type": "tool_call", "name": block["name"],
-                "id": block["id"], "input": block["input"],
-            })
-    return messages
+from simple_agent_loop import init_session, aagent_loop, response
 
 
 # --- Subagent: Shortener ---
 
-def shorten(text: str) -> str:
+# Exact repeats are caught by memoize. Set NEAR_DUPLICATE_THRESHOLD (e.g. 0.95)
+# to also reuse the shortening of a near-identical text. Off by default: the
+# reused summary is the other text's, so any wording that differs is lost.
+_near_duplicate_threshold = os.environ.get("NEAR_DUPLICATE_THRESHOLD")
+near_duplicates = (
+    NearDuplicateCache(threshold=float(_near_duplicate_threshold))
+    if _near_duplicate_threshold else None
+)
+
+SHORTEN_SYSTEM = (
+    "You are a text compressor. Rewrite the user's text to be roughly half "
+    "as long while preserving all key meaning. Output ONLY the shortened plain text, "
+    "no markdown, no headers, no bullet points, no commentary. Just the compressed "
+    "prose paragraph."
+)
+
+
+@memoize(store=llm_cache, salt=SHORTEN_SYSTEM)
+async def shorten(text: str) -> str:
     """Shorten the given text to roughly half its length while preserving meaning.
     Returns JSON with shortened_text and compression_ratio."""
-    session = init_session(
-        system_prompt=(
-            "You are a text compressor. Rewrite the user's text to be roughly half "
-            "as long while preserving all key meaning. Output ONLY the shortened plain text, "
-            "no markdown, no headers, no bullet points, no commentary. Just the compressed "
-            "prose paragraph."
-        ),
-        user_prompt=text,
-    )
-    result = agent_loop(invoke_model, [], session, name="shortener", max_iterations=1)
-    shortened_text = response(result)["content"]
+    # With near_duplicates on, a text within a few words of one already shortened
+    # reuses that output; the ratio is still computed against this text.
+    shortened_text = key = None
+    if near_duplicates is not None:
+        key = await asyncio.to_thread(near_duplicates.key, text)
+        shortened_text = near_duplicates.get(key)
+    if shortened_text is None:
+        session = init_session(system_prompt=SHORTEN_SYSTEM, user_prompt=text)
+        shortener = functools.partial(invoke_model, max_tokens=shorten_max_tokens(text))
+        result = await aagent_loop(shortener, [], session, name="shortener", max_iterations=1)
+        shortened_text = response(result)["content"]
+        if key is not None:
+            near_duplicates.put(key, shortened_text)
+    return _shorten_result(text, shortened_text)
+
+
+def shorten_max_tokens(text):
+    """Output cap for shortening text: the result should be about half as long,
+    so 2/3 of its length in characters leaves ample room in tokens."""
+    return min(16000, max(256, 2 * len(text) // 3))
+
+
+def _shorten_result(text, shortened_text):
     ratio = len(shortened_text) / len(text) if text else 0.0
-    return json.dumps({"compression_ratio": round(ratio, 3), "shortened_text": shortened_text})
+    return orjson.dumps({"compression_ratio": round(ratio, 3), "shortened_text": shortened_text}).decode()
 
 
 # --- Subagent: Judge ---
+# A binary verdict doesn't need the shortener's model: the judge runs on a
+# small, fast one.
+
+JUDGE_MODEL = "claude-haiku-4-5"
+# A verdict and a one-line reason; a truncated verdict would read as too_lossy.
+JUDGE_MAX_TOKENS = 512
+
+JUDGE_SYSTEM = (
+    "You are a compression quality judge. The user will give you an original "
+    "text and a shortened version. Compare them and return ONLY a JSON object: "
+    '{"verdict": "acceptable", "reason": "..."} or '
+    '{"verdict": "too_lossy", "reason": "..."}. '
+    "Verdict should be 'acceptable' if key meaning is preserved, 'too_lossy' "
+    "if important information was lost."
+)
+
+
+def _judge_prompt(original, shortened):
+    return f"ORIGINAL:\n{original}\n\nSHORTENED:\n{shortened}"
 
-def judge(original: str, shortened: str) -> str:
+
+@memoize(store=llm_cache, salt=JUDGE_SYSTEM)
+async def judge(original: str, shortened: str) -> str:
     """Compare original and shortened text. Return JSON verdict."""
-    session = init_session(
-        system_prompt=(
-            "You are a compression quality judge. The user will give you an original "
-            "text and a shortened version. Compare them and return ONLY a JSON object: "
-            '{"verdict": "acceptable", "reason": "..."} or '
-            '{"verdict": "too_lossy", "reason": "..."}. '
-            "Verdict should be 'acceptable' if key meaning is preserved, 'too_lossy' "
-            "if important information was lost."
-        ),
-        user_prompt=f"ORIGINAL:\n{original}\n\nSHORTENED:\n{shortened}",
-    )
-    result = agent_loop(invoke_model, [], session, name="judge", max_iterations=1)
+    session = init_session(system_prompt=JUDGE_SYSTEM, user_prompt=_judge_prompt(original, shortened))
+    judge_model = functools.partial(invoke_model, model=JUDGE_MODEL, max_tokens=JUDGE_MAX_TOKENS)
+    result = await aagent_loop(judge_model, [], session, name="judge", max_iterations=1)
     return response(result)["content"]
 
 
@@ -182,6 +144,216 @@ CRITICAL: You must ALWAYS call `judge` after every `shorten`. Never skip it.
 When you stop, output ONLY the final compressed text with zero commentary."""
 
 
+async def shorten_or_finish(text: str) -> str:
+    """shorten() for the coordinator, with the diminishing-returns stop done in Python.
+
+    Past a 0.9 ratio the coordinator would only spend a turn deciding to stop, so
+    the loop ends here instead. It ends on the text it was given: that has been
+    judged acceptable already (or is the original), the new shortening hasn't.
+    """
+    out = await shorten(text)
+    if orjson.loads(out)["compression_ratio"] > 0.9:
+        raise sal.FinalAnswer(text)
+    return out
+
+
+async def coordinate(text: str) -> str:
+    """Compress text with a coordinator model driving shorten and judge as tools."""
+    session = init_session(
+        system_prompt=COORDINATOR_SYSTEM,
+        user_prompt=text,
+    )
+    result = await aagent_loop(
+        invoke_model,
+        coordinator_tools,
+        session,
+        tool_handlers={"shorten": shorten_or_finish, "judge": judge},
+        name="coordinator",
+    )
+    return response(result)["content"]
+
+
+# --- Python-driven loop ---
+
+def parse_verdict(raw: str) -> str:
+    """Extract the judge's verdict, tolerating prose or code fences around the JSON.
+    Anything unparseable counts as too_lossy so the loop stops on the last good text."""
+    try:
+        return orjson.loads(raw[raw.index("{"):raw.rindex("}") + 1])["verdict"]
+    except (ValueError, KeyError, TypeError):
+        return "too_lossy"
+
+
+async def compress(text: str, max_rounds: int = 10) -> str:
+    """Run the coordinator's procedure directly in Python.
+
+    The stopping rules in COORDINATOR_SYSTEM are fixed, so there's no need to
+    spend a coordinator model call on every step: shorten, judge against the
+    original, and stop on too_lossy or once the ratio exceeds 0.9.
+
+    Each round judges the current candidate and speculatively shortens it in
+    the same gather, so a round costs one model round-trip instead of two. The
+    speculative result is dropped when the judge rejects the candidate. On the
+    last round, or once the ratio exceeds 0.9, only the judge runs.
+    """
+    current = text
+    out = orjson.loads(await shorten(text))
+    for round_ in range(max_rounds):
+        candidate = out["shortened_text"]
+        finishing = out["compression_ratio"] > 0.9 or round_ == max_rounds - 1
+        jobs = [judge(text, candidate)] if finishing else [judge(text, candidate), shorten(candidate)]
+        verdict, *ahead = await asyncio.gather(*jobs)
+        if parse_verdict(verdict) == "too_lossy":
+            break
+        current = candidate
+        if finishing:
+            break
+        out = orjson.loads(ahead[0])
+    return current
+
+# --- One-shot ---
+# The shorten -> judge loop can also run inside a single response: the model
+# compresses, checks itself against the original and repeats, then reports
+# only the result. One model call instead of two per round; compress() stays
+# as the fallback when the reply can't be parsed.
+
+ONE_SHOT_SYSTEM = """\
+You are a text compressor. Compress the user's text as much as possible without \
+losing key meaning, working in rounds:
+
+1. Rewrite the current text to roughly half its length, preserving all key meaning.
+2. Compare the rewrite against the ORIGINAL text. If important information was \
+lost, discard the rewrite and stop.
+3. Stop if the rewrite is more than 90% of the length of the text it came from. \
+Otherwise continue from step 1 with the rewrite, for at most {max_rounds} rounds.
+
+Respond with ONLY a JSON object, no commentary and no code fences:
+{{"shortened": "<last acceptable text>", "self_verdict": "acceptable" or "too_lossy", \
+"ratio": <len(shortened) / len(original)>}}
+where self_verdict is your final check of "shortened" against the original."""
+
+
+async def compress_one_shot(text: str, max_rounds: int = 10) -> str:
+    """compress() in a single model call, falling back to compress() when the
+    reply is not the expected JSON."""
+    session = init_session(system_prompt=ONE_SHOT_SYSTEM.format(max_rounds=max_rounds), user_prompt=text)
+    result = await aagent_loop(invoke_model, [], session, name="compressor", max_iterations=1)
+    raw = response(result)["content"]
+    try:
+        out = orjson.loads(raw[raw.index("{"):raw.rindex("}") + 1])
+        shortened = out["shortened"]
+    except (ValueError, KeyError, TypeError):
+        return await compress(text, max_rounds)
+    if out.get("self_verdict") == "too_lossy" or not isinstance(shortened, str) or not shortened:
+        return text
+    return shortened
+
+
+# --- Batch API ---
+# Compressing many documents means many independent shorten/judge calls. The
+# Message Batches API runs them at half price in exchange for latency, so
+# compress_many(..., use_batch_api=True) moves every text forward one round
+# per batch instead of calling the subagents one at a time.
+
+BATCH_POLL_SECONDS = 10
+
+
+async def run_batch(requests, model="claude-sonnet-4-5"):
+    """Run (system_prompt, user_prompt, max_tokens) requests as one message batch
+    and return the text of each response, in order. Requests that fail come back
+    as None."""
+    if not requests:
+        return []
+    batch = await client.messages.batches.create(requests=[
+        {
+            "custom_id": str(i),
+            "params": dict(
+                model=model,
+                max_tokens=max_tokens,
+                system=system_prompt,
+                messages=[{"role": "user", "content": user_prompt}],
+            ),
+        }
+        for i, (system_prompt, user_prompt, max_tokens) in enumerate(requests)
+    ])
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    texts = {}
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            texts[entry.custom_id] = "".join(
+                block.text for block in entry.result.message.content if block.type == "text"
+            )
+    return [texts.get(str(i)) for i in range(len(requests))]
+
+
+async def shorten_batch(texts: list[str]) -> list[str | None]:
+    """Batch version of shorten: one JSON result per text, or None where the
+    request failed or came back empty."""
+    shortened = await run_batch([(SHORTEN_SYSTEM, text, shorten_max_tokens(text)) for text in texts])
+    return [_shorten_result(text, s) if s else None for text, s in zip(texts, shortened)]
+
+
+async def judge_batch(pairs: list[tuple[str, str]]) -> list[str]:
+    """Batch version of judge: one raw verdict per (original, shortened) pair. A
+    failed request comes back as "", which parse_verdict reads as too_lossy."""
+    verdicts = await run_batch(
+        [(JUDGE_SYSTEM, _judge_prompt(o, s), JUDGE_MAX_TOKENS) for o, s in pairs],
+        model=JUDGE_MODEL,
+    )
+    return [verdict or "" for verdict in verdicts]
+
+
+async def compress_batch(texts: list[str], max_rounds: int = 10) -> list[str]:
+    """compress() for many texts at once, one batch per step. Texts that stop
+    early, or whose shorten request fails, drop out of later batches."""
+    current = list(texts)
+    outs = [out and orjson.loads(out) for out in await shorten_batch(texts)]
+    active = [i for i, out in enumerate(outs) if out is not None]
+    for round_ in range(max_rounds):
+        if not active:
+            break
+        candidates = [outs[i]["shortened_text"] for i in active]
+        # As in compress(), texts that stop after this round aren't shortened again.
+        continuing = [
+            i for i in active
+            if round_ < max_rounds - 1 and outs[i]["compression_ratio"] <= 0.9
+        ]
+        verdicts, ahead = await asyncio.gather(
+            judge_batch([(texts[i], c) for i, c in zip(active, candidates)]),
+            shorten_batch([outs[i]["shortened_text"] for i in continuing]),
+        )
+        ahead = dict(zip(continuing, ahead))
+        still_active = []
+        for i, candidate, verdict in zip(active, candidates, verdicts):
+            if parse_verdict(verdict) == "too_lossy":
+                continue
+            current[i] = candidate
+            if ahead.get(i) is None:
+                continue
+            outs[i] = orjson.loads(ahead[i])
+            still_active.append(i)
+        active = still_active
+    return current
+
+
+async def compress_many(texts: list[str], use_batch_api: bool = False, max_concurrency: int = 10) -> list[str]:
+    """Compress each text independently. With use_batch_api, all texts share
+    message batches. Otherwise up to max_concurrency texts run compress() at a
+    time; the model_calls semaphore still bounds the requests they make."""
+    if use_batch_api:
+        return await compress_batch(texts)
+    running = asyncio.Semaphore(max_concurrency)
+
+    async def one(text):
+        async with running:
+            return await compress(text)
+
+    return list(await asyncio.gather(*(one(text) for text in texts)))
+
+
 if __name__ == "__main__":
     sample_text = (
         "The Amazon rainforest, often referred to as the 'lungs of the Earth,' is a "
@@ -205,19 +377,7 @@ if __name__ == "__main__":
     print(f"\nOriginal length: {len(sample_text)} chars")
     print("=" * 80)
 
-    session = init_session(
-        system_prompt=COORDINATOR_SYSTEM,
-        user_prompt=sample_text,
-    )
-    result = agent_loop(
-        invoke_model,
-        coordinator_tools,
-        session,
-        tool_handlers={"shorten": shorten, "judge": judge},
-        name="coordinator",
-    )
-
-    final = response(result)["content"]
+    final = asyncio.run(compress_one_shot(sample_text))
     print("=" * 80)
     print("\nFINAL COMPRESSED TEXT:")
     print(final)
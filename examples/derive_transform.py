@@ -1,96 +1,13 @@
-import anthropic
-import json
-from dotenv import load_dotenv
-import simple_agent_loop as sal
-from simple_agent_loop import init_session, agent_loop, response
-
-load_dotenv()
-
-client = anthropic.Anthropic()
-
-
-def invoke_model(tools, session):
-    # Convert generic messages to Anthropic API format
-    system_prompt = None
-    api_messages = []
-    assistant_blocks = []
-    tool_result_blocks = []
-
-    def flush_assistant():
-        nonlocal assistant_blocks
-        if assistant_blocks:
-            api_messages.append({"role": "assistant", "content": assistant_blocks})
-            assistant_blocks = []
-
-    def flush_tool_results():
-        nonlocal tool_result_blocks
-        if tool_result_blocks:
-            api_messages.append({"role": "user", "content": tool_result_blocks})
-            tool_result_blocks = []
-
-    for msg in session["messages"]:
-        role = msg.get("role")
-        msg_type = msg.get("type")
-        if role == "system":
-            system_prompt = msg["content"]
-        elif role == "user":
-            flush_assistant()
-            flush_tool_results()
-            api_messages.append({"role": "user", "content": msg["content"]})
-        elif role == "assistant":
-            flush_tool_results()
-            assistant_blocks.append({"type": "text", "text": msg["content"]})
-        elif msg_type == "thinking":
-            flush_tool_results()
-            block = {"type": "thinking", "thinking": msg["content"]}
-            if "signature" in msg:
-                block["signature"] = msg["signature"]
-            assistant_blocks.append(block)
-        elif msg_type == "tool_call":
-            flush_tool_results()
-            assistant_blocks.append({
-                "type": "tool_use", "id": msg["id"],
-                "name": msg["name"], "input": msg["input"],
-            })
-        elif msg_type == "tool_result":
-            flush_assistant()
-            output = msg["output"]
-            tool_result_blocks.append({
-                "type": "tool_result", "tool_use_id": msg["id"],
-                "content": output if isinstance(output, str) else json.dumps(output),
-            })
-    flush_assistant()
-    flush_tool_results()
-
-    # Call the model
-    kwargs = dict(model="claude-sonnet-4-5", max_tokens=16000, messages=api_messages)
-    if system_prompt:
-        kwargs["system"] = system_prompt
-    if tools:
-        kwargs["tools"] = tools
-    api_response = client.messages.create(**kwargs).to_dict()
-
-    # Parse response back to generic messages
-    messages = []
-    for block in api_response.get("content", []):
-        if block["type"] == "thinking":
-            msg = {"type": "thinking", "content": block["thinking"], "ts": sal.now()}
-            if "signature" in block:
-                msg["signature"] = block["signature"]
-            messages.append(msg)
-        elif block["type"] == "text" and block["text"]:
-            messages.append({"role": "assistant", "content": block["text"], "ts": sal.now()})
-        elif block["type"] == "tool_use":
-            messages.append({
-                "type": "tool_call", "name": block["name"],
-                "id": block["id"], "input": block["input"],
-            })
-    return messages
+import asyncio
+from anthropic_model import invoke_model
+from llm_cache import memoize
+from simple_agent_loop import init_session, aagent_loop, response
 
 
 # --- Subagent: Editor ---
 
-def edit(text: str, rules: str, specific_info: str) -> str:
+@memoize()
+async def edit(text: str, rules: str, specific_info: str) -> str:
     """Apply transformation rules and specific info to source text, return transformed text."""
     session = init_session(
         system_prompt=(
@@ -99,83 +16,53 @@ def edit(text: str, rules: str, specific_info: str) -> str:
         ),
         user_prompt=f"SOURCE TEXT:\n{text}\n\nRULES:\n{rules}\n\nSPECIFIC INFO:\n{specific_info}",
     )
-    result = agent_loop(invoke_model, [], session, name="editor", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="editor", max_iterations=1)
     output = response(result)["content"]
     print(f"\n--- Editor Output ---\n{output}\n--- End Output ---\n")
     return output
 
 
-# --- Subagent: Similarity Judge ---
+# --- Subagent: Combined Judge ---
 
-def judge_similarity(editor_output: str, target: str) -> str:
-    """Compare editor output against target text. Return JSON with score and differences."""
+@memoize()
+async def judge_all(editor_output: str, target: str, rules: str, specific_info: str) -> str:
+    """Score similarity, rule generality and specific_info cleanliness in one call.
+    Return JSON with one {"score", ...} object per criterion."""
     session = init_session(
         system_prompt=(
-            "You are a similarity judge. Compare the editor output against the target text. "
+            "You are a panel of three judges evaluating a derived text transformation. "
+            "Score each criterion independently.\n\n"
+            "1. similarity: Compare the editor output against the target text. "
+            "100 means a perfect match. Be strict: wording doesn't need to be identical, "
+            "but all content, tone, structure, and formatting must match. Deduct points "
+            "for any missing, extra, or mismatched content.\n\n"
+            "2. generality: Check that the rules are fully general and contain NO specific "
+            "content from any particular text -- no specific names, numbers, dates, quoted "
+            "phrases, or other concrete details. Rules should describe transformations "
+            "abstractly (e.g. 'change tone from casual to formal') not reference specific "
+            "content (e.g. 'change John to Mr. Smith'). 100 means fully abstract with zero "
+            "specific content. Deduct points for each piece of specific content that leaked "
+            "into the rules.\n\n"
+            "3. specific_info: Check that the specific info is ONLY a flat list of specific "
+            "facts and snippets of information -- names, dates, numbers, titles, labels, and "
+            "other concrete details. Deduct points heavily for explanations or reasoning, "
+            "formatting or structure notes, verbatim text to include, and instructions or "
+            "directives. It should contain ONLY raw facts like: 'Full name: Michael Chen', "
+            "'Title: Project Lead', 'Date: March 15, 2025'. 100 means a clean flat list of "
+            "facts.\n\n"
             "Return ONLY a JSON object: "
-            '{"score": <0-100>, "differences": "..."} where score reflects how closely the '
-            "editor output matches the target. 100 means a perfect match. "
-            "Be strict: wording doesn't need to be identical, but all content, tone, "
-            "structure, and formatting must match. Deduct points for any missing, extra, "
-            "or mismatched content."
+            '{"similarity": {"score": <0-100>, "differences": "..."}, '
+            '"generality": {"score": <0-100>, "issues": "..."}, '
+            '"specific_info": {"score": <0-100>, "issues": "..."}}'
         ),
-        user_prompt=f"EDITOR OUTPUT:\n{editor_output}\n\nTARGET:\n{target}",
-    )
-    result = agent_loop(invoke_model, [], session, name="similarity-judge", max_iterations=1)
-    output = response(result)["content"]
-    print(f"\n--- Similarity Judge ---\n{output}\n")
-    return output
-
-
-# --- Subagent: Generality Judge ---
-
-def judge_generality(rules: str) -> str:
-    """Check that rules contain no specific content. Return JSON with score and issues."""
-    session = init_session(
-        system_prompt=(
-            "You are a generality judge. Check that the given transformation rules are "
-            "fully general and contain NO specific content from any particular text -- "
-            "no specific names, numbers, dates, quoted phrases, or other concrete details. "
-            "Rules should describe transformations abstractly (e.g. 'change tone from casual "
-            "to formal') not reference specific content (e.g. 'change John to Mr. Smith'). "
-            "Return ONLY a JSON object: "
-            '{"score": <0-100>, "issues": "..."} where score reflects how general the rules are. '
-            "100 means fully abstract with zero specific content. Deduct points for each "
-            "piece of specific content that leaked into the rules."
+        user_prompt=(
+            f"EDITOR OUTPUT:\n{editor_output}\n\nTARGET:\n{target}\n\n"
+            f"RULES:\n{rules}\n\nSPECIFIC INFO:\n{specific_info}"
         ),
-        user_prompt=f"RULES:\n{rules}",
     )
-    result = agent_loop(invoke_model, [], session, name="generality-judge", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="judge", max_iterations=1)
     output = response(result)["content"]
-    print(f"\n--- Generality Judge ---\n{output}\n")
-    return output
-
-
-# --- Subagent: Specific Info Judge ---
-
-def judge_specific_info(specific_info: str) -> str:
-    """Check that specific_info is a flat list of facts. Return JSON with score and issues."""
-    session = init_session(
-        system_prompt=(
-            "You are a specific-info judge. Check that the given specific_info is ONLY a flat "
-            "list of specific facts and snippets of information -- names, dates, numbers, titles, "
-            "labels, and other concrete details.\n\n"
-            "Deduct points heavily for:\n"
-            "- Explanations or reasoning (e.g. 'because the tone is formal, use...')\n"
-            "- Formatting or structure notes (e.g. 'use a numbered list', 'add a header')\n"
-            "- Verbatim text to include (e.g. 'write: Please be advised that...')\n"
-            "- Instructions or directives (e.g. 'change X to Y', 'make sure to...')\n\n"
-            "specific_info should contain ONLY raw facts like: "
-            "'Full name: Michael Chen', 'Title: Project Lead', 'Date: March 15, 2025'. "
-            "Return ONLY a JSON object: "
-            '{"score": <0-100>, "issues": "..."} where 100 means a clean flat list of facts '
-            "with no explanations, structure notes, or verbatim copy."
-        ),
-        user_prompt=f"SPECIFIC INFO:\n{specific_info}",
-    )
-    result = agent_loop(invoke_model, [], session, name="specific-info-judge", max_iterations=1)
-    output = response(result)["content"]
-    print(f"\n--- Specific Info Judge ---\n{output}\n")
+    print(f"\n--- Judges ---\n{output}\n")
     return output
 
 
@@ -199,47 +86,23 @@ coordinator_tools = [
         },
     },
     {
-        "name": "judge_similarity",
+        "name": "judge_all",
         "description": (
-            "Compare editor output against target text. "
-            'Returns JSON with "score" (0-100) and "differences" (string).'
+            "Judge one edit on all three criteria at once: similarity of the editor output "
+            "to the target, generality of the rules, and whether specific_info is a flat "
+            "list of facts. "
+            'Returns JSON with "similarity", "generality" and "specific_info" objects, '
+            'each with a "score" (0-100) and feedback ("differences" or "issues").'
         ),
         "input_schema": {
             "type": "object",
             "properties": {
                 "editor_output": {"type": "string", "description": "The text produced by the editor"},
                 "target": {"type": "string", "description": "The target text to compare against"},
-            },
-            "required": ["editor_output", "target"],
-        },
-    },
-    {
-        "name": "judge_generality",
-        "description": (
-            "Check that rules contain no specific content (names, numbers, quotes). "
-            'Returns JSON with "score" (0-100) and "issues" (string).'
-        ),
-        "input_schema": {
-            "type": "object",
-            "properties": {
                 "rules": {"type": "string", "description": "The transformation rules to evaluate"},
-            },
-            "required": ["rules"],
-        },
-    },
-    {
-        "name": "judge_specific_info",
-        "description": (
-            "Check that specific_info is a flat list of facts with no explanations, "
-            "structure notes, or verbatim copy. "
-            'Returns JSON with "score" (0-100) and "issues" (string).'
-        ),
-        "input_schema": {
-            "type": "object",
-            "properties": {
                 "specific_info": {"type": "string", "description": "The specific_info to evaluate"},
             },
-            "required": ["specific_info"],
+            "required": ["editor_output", "target", "rules", "specific_info"],
         },
     },
     {
@@ -277,18 +140,17 @@ Step 1: Analyze the source and target. Draft initial `rules` (general transforms
 `specific_info` (concrete details needed).
 Step 1b: Call `print` to display your drafted rules and specific_info so the user can monitor.
 Step 2: Call `edit` with the source text, your rules, and specific_info.
-Step 3: Call ALL THREE judges in parallel: \
-`judge_similarity` (comparing editor output to target), \
-`judge_generality` (checking your rules), and \
-`judge_specific_info` (checking your specific_info).
+Step 3: Call `judge_all` once with the editor output, the target, your rules, and \
+your specific_info. It scores similarity (editor output vs target), generality \
+(your rules), and specific_info (your specific_info) in a single response.
 Step 4: Check results:
-  - If ALL THREE judges score above 90: STOP. Output ONLY a JSON object: \
+  - If ALL THREE scores are above 90: STOP. Output ONLY a JSON object: \
 {"rules": "...", "specific_info": "..."}
-  - If ALL THREE judges score above 90 YOU MUST STOP. Do NOT continue past this point of diminishing returns.
-  - If any judge scores 90 or below: refine your rules and/or specific_info based \
+  - If ALL THREE scores are above 90 YOU MUST STOP. Do NOT continue past this point of diminishing returns.
+  - If any score is 90 or below: refine your rules and/or specific_info based \
 on the feedback, then call `print` with your updated rules and specific_info, and go back to Step 2.
 
-CRITICAL: Always call all three judges after every edit. Never skip a judge. \
+CRITICAL: Always call `judge_all` after every edit. Never skip it. \
 When you stop, output ONLY the final JSON object with zero commentary."""
 
 
@@ -332,20 +194,18 @@ if __name__ == "__main__":
         system_prompt=COORDINATOR_SYSTEM,
         user_prompt=f"SOURCE TEXT:\n{source}\n\nTARGET TEXT:\n{target}",
     )
-    result = agent_loop(
+    result = asyncio.run(aagent_loop(
         invoke_model,
         coordinator_tools,
         session,
         tool_handlers={
             "edit": edit,
-            "judge_similarity": judge_similarity,
-            "judge_generality": judge_generality,
-            "judge_specific_info": judge_specific_info,
+            "judge_all": judge_all,
             "print": print_to_stdout,
         },
         name="coordinator",
         max_iterations=30,
-    )
+    ))
 
     final = response(result)
     print("\n" + "=" * 80)
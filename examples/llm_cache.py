@@ -0,0 +1,190 @@
+"""Response cache for deterministic model calls, shared by the examples.
+
+Keys are the SHA-256 of the full request (model, system, messages, tools, ...)
+and values are the response dicts returned by the API. Entries are kept in an
+in-memory LRU and, when a path is given, in a sqlite file so reruns skip the
+network as well.
+
+`memoize` sits one level up: it caches whole subagent calls by their
+arguments, optionally persisting them to the same store, so a coordinator
+that repeats a call verbatim doesn't even build a session.
+`NearDuplicateCache` also matches inputs that differ by a few words (but
+not in any number).
+"""
+import asyncio
+import functools
+import hashlib
+import orjson
+import os
+import random
+import re
+import sqlite3
+from collections import OrderedDict
+
+
+def cache_key(**request):
+    payload = orjson.dumps(request, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(payload).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, maxsize=1024, path=None):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(os.path.expanduser(path))
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = orjson.loads(row[0])
+                self._remember(key, value)
+                return value
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                    (key, orjson.dumps(value).decode()),
+                )
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def memoize(maxsize=512, store=None, salt=None):
+    """Cache an async function's results by its (hashable) arguments.
+
+    functools.lru_cache would cache the coroutine object, which can only be
+    awaited once. This caches a task instead, so concurrent callers with the
+    same arguments share one in-flight call. Failed or cancelled calls are evicted.
+
+    With a store (an LLMCache), results are also kept under a SHA-256 of the
+    function name, salt and arguments, so they survive reruns when the store
+    has a path. Pass the function's prompt as salt so editing it invalidates
+    what was stored.
+    """
+    def decorator(fn):
+        tasks = OrderedDict()
+
+        async def call(args, kwargs):
+            if store is None:
+                return await fn(*args, **kwargs)
+            key = cache_key(fn=fn.__qualname__, salt=salt, args=args, kwargs=kwargs)
+            value = store.get(key)
+            if value is None:
+                value = await fn(*args, **kwargs)
+                store.put(key, value)
+            return value
+
+        def evict_unless_result(key, task):
+            # Failed and cancelled calls (e.g. when their event loop shut down)
+            # must not be served to later callers.
+            if (task.cancelled() or task.exception() is not None) and tasks.get(key) is task:
+                del tasks[key]
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            task = tasks.get(key)
+            if task is None:
+                task = tasks[key] = asyncio.ensure_future(call(args, kwargs))
+                task.add_done_callback(functools.partial(evict_unless_result, key))
+                while len(tasks) > maxsize:
+                    tasks.popitem(last=False)
+            else:
+                tasks.move_to_end(key)
+            return await asyncio.shield(task)
+
+        wrapper.cache_clear = tasks.clear
+        return wrapper
+    return decorator
+
+
+_MERSENNE = (1 << 61) - 1
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+class NearDuplicateCache:
+    """LRU map from texts to values that also answers for near-identical texts.
+
+    Each text is reduced to a MinHash signature over its word 3-grams. Signatures
+    are split into bands and bucketed (LSH), so a lookup only compares against
+    entries sharing a band. A match is returned when the estimated Jaccard
+    similarity of the shingle sets reaches threshold and both texts contain the
+    same numbers: changing a figure barely moves the similarity but changes the
+    facts, so such texts never share a value.
+
+    Lookups take a key from `key(text)`. Computing it is pure-Python hashing
+    that grows with the text, so compute it once per text, off the event loop
+    (`await asyncio.to_thread(cache.key, text)`), and pass it to get and put.
+    """
+
+    def __init__(self, threshold=0.95, num_perm=128, bands=16, maxsize=1024):
+        self.threshold = threshold
+        self.bands = bands
+        self.maxsize = maxsize
+        rng = random.Random(0)
+        self._perms = [(rng.randrange(1, _MERSENNE), rng.randrange(_MERSENNE)) for _ in range(num_perm)]
+        self._entries = OrderedDict()  # key -> value
+        self._buckets = {}  # (band, band signature) -> keys
+
+    def key(self, text):
+        """The text's lookup key: its MinHash signature and the numbers in it."""
+        words = text.split()
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+            for s in shingles
+        ]
+        signature = tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perms)
+        return signature, tuple(_NUMBER.findall(text))
+
+    def _band_keys(self, signature):
+        rows = len(signature) // self.bands
+        return [(i, signature[i * rows:(i + 1) * rows]) for i in range(self.bands)]
+
+    def get(self, key):
+        signature, numbers = key
+        candidates = set()
+        for band in self._band_keys(signature):
+            candidates.update(self._buckets.get(band, ()))
+        best, best_similarity = None, self.threshold
+        for other in candidates:
+            if other[1] != numbers:
+                continue
+            similarity = sum(a == b for a, b in zip(signature, other[0])) / len(signature)
+            if similarity >= best_similarity:
+                best, best_similarity = other, similarity
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best]
+
+    def put(self, key, value):
+        if key not in self._entries:
+            for band in self._band_keys(key[0]):
+                self._buckets.setdefault(band, set()).add(key)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            evicted, _ = self._entries.popitem(last=False)
+            for band in self._band_keys(evicted[0]):
+                bucket = self._buckets[band]
+                bucket.discard(evicted)
+                if not bucket:
+                    del self._buckets[band]
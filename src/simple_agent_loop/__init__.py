@@ -1,9 +1,52 @@
 from datetime import datetime, timezone
-import copy
+import asyncio
+import contextlib
+import functools
+import inspect
 import json
+import os
+import re
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:  # optional, see the "fast" extra
+    orjson = None
+
+
+def _dumps(obj, sort_keys=False):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+        except TypeError:  # e.g. integers wider than 64 bits, which json handles
+            pass
+    return json.dumps(obj, sort_keys=sort_keys)
+
+
+# orjson parses integers wider than 64 bits as floats; json keeps them exact.
+_WIDE_INT = re.compile(r"\d{19}")
+
+
+def _loads(text):
+    if orjson is not None and not _WIDE_INT.search(text):
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+_now_cache = (None, None)
+
 
 def now():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    # Timestamps have one-second resolution, so format each second only once.
+    # The (second, text) pair is swapped in as one tuple to stay thread-safe.
+    global _now_cache
+    second = int(time.time())
+    cached_second, text = _now_cache
+    if second != cached_second:
+        text = datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        _now_cache = (second, text)
+    return text
 
 
 def init_session(system_prompt, user_prompt):
@@ -17,83 +60,340 @@ def init_session(system_prompt, user_prompt):
 
 def extend_session(session, message):
     session["messages"].append(message)
+    if message.get("role") == "assistant":
+        session["_last_assistant_idx"] = len(session["messages"]) - 1
 
 
 def send(session, user_message):
     extend_session(session, {"role": "user", "content": user_message, "ts": now()})
 
 
+def _clone_message(msg):
+    clone = dict(msg)
+    for key in ("content", "input"):
+        value = clone.get(key)
+        if isinstance(value, list):
+            clone[key] = [dict(b) if isinstance(b, dict) else b for b in value]
+        elif isinstance(value, dict):
+            clone[key] = dict(value)
+    return clone
+
+
+# Session keys holding state derived from the messages, e.g. the API-format
+# conversion an invoke_model may cache in "_api_cache", the log of messages
+# compact_session rewrote in place and the messages_by_type index. A fork
+# rebuilds its own.
+_DERIVED_KEYS = ("_api_cache", "_compacted", "_by_type")
+
+
 def fork_session(session):
-    return copy.deepcopy(session)
+    """Copy a session for branching.
+
+    Message dicts (and any block lists or input dicts inside them) are copied so
+    either branch can be extended or compacted independently. Strings are
+    immutable and shared rather than copied.
+    """
+    forked = {k: v for k, v in session.items() if k not in _DERIVED_KEYS}
+    if "_history_full" in forked:
+        forked["_history_full"] = dict(forked["_history_full"])
+    forked["messages"] = [_clone_message(m) for m in session["messages"]]
+    return forked
 
 
 def response(session):
-    for msg in reversed(session["messages"]):
-        if msg.get("role") == "assistant":
-            return msg
+    messages = session["messages"]
+    # Only messages after the tracked index can be newer assistant messages (e.g.
+    # ones appended directly rather than through extend_session). If the index is
+    # unset or stale (messages were removed), scan the whole session.
+    idx = session.get("_last_assistant_idx")
+    start = 0
+    if idx is not None and idx < len(messages) and messages[idx].get("role") == "assistant":
+        start = idx
+    for i in range(len(messages) - 1, start - 1, -1):
+        if messages[i].get("role") == "assistant":
+            return messages[i]
     return None
 
 
-def execute_tool_calls(tool_calls, tool_handlers, parallel=True):
-    """Execute tool calls. When parallel=True (default), uses ThreadPoolExecutor. When False, executes sequentially."""
-    results = []
-
-    if parallel:
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_tc = {}
-            for tc in tool_calls:
-                handler = tool_handlers.get(tc["name"])
-                if handler is None:
-                    results.append({
-                        "type": "tool_result",
-                        "id": tc["id"],
-                        "output": f"Error: unknown tool '{tc['name']}'",
-                    })
-                    continue
-                future = executor.submit(handler, **tc["input"])
-                future_to_tc[future] = tc
-
-            for future in concurrent.futures.as_completed(future_to_tc):
-                tc = future_to_tc[future]
-                try:
-                    output = future.result()
-                    results.append({
-                        "type": "tool_result",
-                        "id": tc["id"],
-                        "output": output,
-                    })
-                except Exception as e:
-                    results.append({
-                        "type": "tool_result",
-                        "id": tc["id"],
-                        "output": f"Error: {e}",
-                    })
+def _message_kind(msg):
+    return msg.get("type") or msg.get("role")
+
+
+def messages_by_type(session, kind):
+    """Return the session's messages of one kind, oldest first.
+
+    The kind is a message's type ("tool_call", "tool_result", "thinking") or, for
+    plain messages, its role ("user", "assistant", ...). Message indices are
+    bucketed by kind in session["_by_type"], which catches up with any messages
+    appended since the last call, so repeated lookups don't rescan the session.
+    The index is rebuilt if messages were removed or replaced since.
+    """
+    messages = session["messages"]
+    index = session.get("_by_type")
+    # The index is only valid while messages grow. If the last message it saw is
+    # gone or moved (messages were truncated, popped or replaced), start over.
+    if index is not None and index["len"] and (
+        index["len"] > len(messages) or messages[index["len"] - 1] is not index["last"]
+    ):
+        index = None
+    if index is None:
+        index = session["_by_type"] = {"len": 0, "last": None, "kinds": {}}
+    kinds = index["kinds"]
+    for i in range(index["len"], len(messages)):
+        kinds.setdefault(_message_kind(messages[i]), []).append(i)
+    index["len"] = len(messages)
+    index["last"] = messages[-1] if messages else None
+    found = [messages[i] for i in kinds.get(kind, ())]
+    if any(_message_kind(msg) != kind for msg in found):
+        # An earlier message was replaced by one of another kind.
+        del session["_by_type"]
+        return messages_by_type(session, kind)
+    return found
+
+
+# Upper bound on top-level tool calls running at once on the shared pool. Tool
+# handlers are typically model API calls, so going past the provider's rate limit
+# only buys 429s. Calls nested inside a handler run on their own executors.
+MAX_TOOL_PARALLELISM = int(os.environ.get("AGENT_MAX_TOOL_PARALLELISM", "8"))
+
+_TOOL_POOL = None
+_tool_pool_lock = threading.Lock()
+_tool_thread = threading.local()
+
+
+def _mark_tool_thread():
+    _tool_thread.in_pool = True
+
+
+def _tool_pool():
+    """Return the executor shared by all parallel tool calls.
+
+    It is created on first use, so sequential-only environments never start threads.
+    """
+    global _TOOL_POOL
+    with _tool_pool_lock:
+        if _TOOL_POOL is None:
+            import atexit
+            import concurrent.futures
+            _TOOL_POOL = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_TOOL_PARALLELISM, thread_name_prefix="tool", initializer=_mark_tool_thread,
+            )
+            atexit.register(_TOOL_POOL.shutdown)
+        return _TOOL_POOL
+
+
+class FinalAnswer(Exception):
+    """Raised by a tool handler to end the agent loop with content as its answer.
+
+    The handler's tool_result records the content and is marked "final"; the loop
+    then appends it as the assistant's response instead of calling the model again.
+    Use it when a handler can already tell the loop is done.
+    """
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.content = content
+
+
+def _final_result(tc, e):
+    return {
+        "type": "tool_result",
+        "id": tc["id"],
+        "output": e.content,
+        "final": True,
+    }
+
+
+def _tool_result(tc, tool_handlers):
+    handler = tool_handlers.get(tc["name"])
+    if handler is None:
+        output = f"Error: unknown tool '{tc['name']}'"
     else:
-        for tc in tool_calls:
-            handler = tool_handlers.get(tc["name"])
-            if handler is None:
-                results.append({
-                    "type": "tool_result",
-                    "id": tc["id"],
-                    "output": f"Error: unknown tool '{tc['name']}'",
-                })
-                continue
-            try:
-                output = handler(**tc["input"])
-                results.append({
-                    "type": "tool_result",
-                    "id": tc["id"],
-                    "output": output,
-                })
-            except Exception as e:
-                results.append({
-                    "type": "tool_result",
-                    "id": tc["id"],
-                    "output": f"Error: {e}",
-                })
-
-    return results
+        try:
+            output = handler(**tc["input"])
+        except FinalAnswer as e:
+            return _final_result(tc, e)
+        except Exception as e:
+            output = f"Error: {e}"
+    return {
+        "type": "tool_result",
+        "id": tc["id"],
+        "output": output,
+    }
+
+
+@contextlib.contextmanager
+def _tool_executor():
+    # A handler that runs its own agent loop (a subagent) calls back in here from
+    # a pool thread. Blocking that thread on the shared pool could exhaust its
+    # workers, so nested calls get a short-lived executor of their own, sized like
+    # the pool: the limit then holds per batch of nested calls, not across levels.
+    if not getattr(_tool_thread, "in_pool", False):
+        yield _tool_pool()
+        return
+    import concurrent.futures
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_TOOL_PARALLELISM, initializer=_mark_tool_thread,
+    )
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+
+
+def _call_key(tc, dedupe=True):
+    """Identify a tool call by its name and canonical input, so repeats within a turn
+    can share one execution. With dedupe=False, or when the input can't be
+    serialized to JSON, every call is its own key."""
+    if not dedupe:
+        return id(tc)
+    try:
+        return tc["name"], _dumps(tc["input"], sort_keys=True)
+    except (TypeError, ValueError):  # not JSON-serializable, so never treated as a repeat
+        return id(tc)
+
+
+def _result_for(result, tc):
+    """Answer tc with the result of an identical call."""
+    return result if result["id"] == tc["id"] else {**result, "id": tc["id"]}
+
+
+def execute_tool_calls(tool_calls, tool_handlers, parallel=True, dedupe=True):
+    """Execute tool calls, returning tool_result messages in call order.
+
+    When parallel=True (default), uses a shared ThreadPoolExecutor. When False, executes sequentially.
+    With dedupe=True (default), calls with the same name and input run once and the
+    duplicates get a copy of the result. Pass dedupe=False for tools with side effects
+    that must run once per call.
+    """
+    keys = [_call_key(tc, dedupe) for tc in tool_calls]
+    if not parallel:
+        results = {}
+        for key, tc in zip(keys, tool_calls):
+            if key not in results:
+                results[key] = _tool_result(tc, tool_handlers)
+        return [_result_for(results[key], tc) for key, tc in zip(keys, tool_calls)]
+
+    with _tool_executor() as executor:
+        futures = {}
+        for key, tc in zip(keys, tool_calls):
+            if key not in futures:
+                futures[key] = executor.submit(_tool_result, tc, tool_handlers)
+        return [_result_for(futures[key].result(), tc) for key, tc in zip(keys, tool_calls)]
+
+
+async def _atool_result(tc, tool_handlers):
+    handler = tool_handlers.get(tc["name"])
+    if handler is None:
+        output = f"Error: unknown tool '{tc['name']}'"
+    else:
+        try:
+            if inspect.iscoroutinefunction(handler):
+                output = await handler(**tc["input"])
+            else:
+                # Plain handlers would block the event loop, and with it every other
+                # tool call, so they run on the tool pool instead. From inside a pool
+                # thread, the loop's default executor avoids exhausting the pool.
+                executor = None if getattr(_tool_thread, "in_pool", False) else _tool_pool()
+                output = await asyncio.get_running_loop().run_in_executor(
+                    executor, functools.partial(handler, **tc["input"])
+                )
+                if inspect.isawaitable(output):
+                    output = await output
+        except FinalAnswer as e:
+            return _final_result(tc, e)
+        except Exception as e:
+            output = f"Error: {e}"
+    return {
+        "type": "tool_result",
+        "id": tc["id"],
+        "output": output,
+    }
+
+
+async def aexecute_tool_calls(tool_calls, tool_handlers, dedupe=True):
+    """Execute tool calls concurrently on the running event loop.
+
+    Handlers may be coroutine functions (e.g. subagents built on aagent_loop) or
+    plain functions, which run on the shared tool pool so they overlap too.
+    Results are returned in the same order as tool_calls. With dedupe=True
+    (default), calls with the same name and input run once; pass dedupe=False
+    for tools with side effects that must run once per call.
+    """
+    keys = [_call_key(tc, dedupe) for tc in tool_calls]
+    tasks = {}
+    for key, tc in zip(keys, tool_calls):
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(_atool_result(tc, tool_handlers))
+    await asyncio.gather(*tasks.values())
+    return [_result_for(tasks[key].result(), tc) for key, tc in zip(keys, tool_calls)]
+
+
+async def _aiter_messages(response):
+    if hasattr(response, "__aiter__"):
+        async for msg in response:
+            yield msg
+        return
+    if inspect.isawaitable(response):
+        response = await response
+    for msg in response:
+        yield msg
+
+
+def _compile_tool(name, handler, params, required):
+    def bind(tool_input):
+        missing = [k for k in required if k not in tool_input]
+        if missing:
+            raise ValueError(f"tool '{name}' is missing required input: {', '.join(missing)}")
+        return {k: tool_input[k] for k in params if k in tool_input}
+
+    if inspect.iscoroutinefunction(handler):
+        async def call(**tool_input):
+            return await handler(**bind(tool_input))
+    else:
+        def call(**tool_input):
+            return handler(**bind(tool_input))
+    return call
+
+
+def register_tools(tool_handlers, tools):
+    """Bind each handler to its tool schema once, before the loop starts.
+
+    The returned handlers are called like the originals, with the tool input as
+    keyword arguments, but keys the schema doesn't declare are dropped and missing
+    required keys raise a clear error (reported to the model as the tool result).
+    Handlers without a matching schema are passed through unchanged.
+    """
+    compiled = dict(tool_handlers)
+    for spec in tools:
+        handler = tool_handlers.get(spec["name"])
+        schema = spec.get("input_schema") or {}
+        if handler is None or "properties" not in schema:
+            continue
+        compiled[spec["name"]] = _compile_tool(
+            spec["name"], handler, tuple(schema["properties"]), tuple(schema.get("required", ())),
+        )
+    return compiled
+
+
+def _log_content(message):
+    return message.get("content", "")
+
+
+def _log_tool_call(message):
+    return f"{message['name']}({_dumps(message['input'])})"
+
+
+def _log_tool_result(message):
+    output = message.get("output", "")
+    return output if isinstance(output, str) else _dumps(output)
+
+
+# Message type -> how log renders it; anything else logs its content.
+_LOG_FORMATTERS = {
+    "tool_call": _log_tool_call,
+    "tool_result": _log_tool_result,
+}
 
 
 def log(message, name=None):
@@ -104,16 +404,7 @@ def log(message, name=None):
     msg_type = message.get("type", "")
     label = role or msg_type
 
-    if msg_type == "thinking":
-        content = message.get("content", "")
-    elif msg_type == "tool_call":
-        content = f"{message['name']}({json.dumps(message['input'])})"
-    elif msg_type == "tool_result":
-        output = message.get("output", "")
-        content = output if isinstance(output, str) else json.dumps(output)
-    else:
-        content = message.get("content", "")
-
+    content = _LOG_FORMATTERS.get(msg_type, _log_content)(message)
     content = content.replace("\n", " ").strip()
     line = f"{ts} {agent} {label} {content}"
     if len(line) > 120:
@@ -121,30 +412,106 @@ def log(message, name=None):
     print(line)
 
 
+# Sessions longer than this also get old judge-style tool results compacted.
+COMPACT_THRESHOLD = 20
+
+_VERDICT_KEYS = ("score", "verdict")
+
+
+def _is_model_message(msg):
+    return msg.get("role") == "assistant" or msg.get("type") in ("thinking", "tool_call")
+
+
+def _verdict_summary(obj):
+    """Reduce a judge-style result to its score/verdict fields, or None if it has none.
+
+    Handles one object per criterion too, e.g. {"similarity": {"score": ..}, ...}.
+    """
+    if not isinstance(obj, dict) or not obj:
+        return None
+    summary = {k: obj[k] for k in _VERDICT_KEYS if k in obj}
+    if summary:
+        return summary
+    nested = {k: _verdict_summary(v) for k, v in obj.items()}
+    if all(v is not None for v in nested.values()):
+        return nested
+    return None
+
+
+def _compact_tool_result(session, i, msg):
+    output = msg["output"]
+    parsed = output
+    if isinstance(output, str):
+        try:
+            parsed = _loads(output)
+        except ValueError:
+            return
+    summary = _verdict_summary(parsed)
+    if summary is None:
+        return
+    compacted = _dumps(summary)
+    if len(compacted) >= len(output if isinstance(output, str) else _dumps(output)):
+        return
+    session.setdefault("_history_full", {})[i] = output
+    msg["output"] = compacted
+    msg["compacted"] = True
+    session.setdefault("_compacted", []).append(i)
+
+
 def compact_session(session):
     """Compact old thinking and tool_call messages to save context window space.
 
     Only compacts messages where the model has responded (assistant role)
     at least twice since that message. Keeps the first 120 chars of content.
+
+    Once the session is longer than COMPACT_THRESHOLD, tool results from before
+    the last two model responses whose output is judge-style JSON (a "score" or
+    "verdict" field) are cut down to just those fields. The original outputs are
+    kept in session["_history_full"], keyed by message index.
+
+    Indices of rewritten messages are appended to session["_compacted"] so an
+    invoke_model that caches converted messages can refresh just those.
+
+    A message only gets further from the end as the session grows, so once it
+    has been compacted or passed over as too short it is settled for good.
+    session["_compact_from"] records where the settled prefix ends, and later
+    calls only walk the messages after it.
     """
     messages = session["messages"]
+    compact_results = len(messages) > COMPACT_THRESHOLD
     assistant_count = 0
-    for i in range(len(messages) - 1, -1, -1):
+    model_turns = 0
+    unsettled = len(messages)
+    for i in range(len(messages) - 1, session.get("_compact_from", 0) - 1, -1):
         msg = messages[i]
         if msg.get("role") == "assistant":
             assistant_count += 1
-        if assistant_count >= 2 and not msg.get("compacted"):
-            msg_type = msg.get("type")
+        if _is_model_message(msg) and (i == len(messages) - 1 or not _is_model_message(messages[i + 1])):
+            model_turns += 1
+        if msg.get("compacted"):
+            continue
+        msg_type = msg.get("type")
+        if msg_type == "tool_result":
+            if compact_results and model_turns >= 2:
+                _compact_tool_result(session, i, msg)
+            else:
+                unsettled = i
+        elif msg_type in ("thinking", "tool_call") and assistant_count < 2:
+            unsettled = i
+        elif assistant_count >= 2:
             if msg_type == "thinking":
                 content = msg["content"]
                 if len(content) > 120:
                     msg["content"] = content[:120] + "..."
                     msg["compacted"] = True
+                    session.setdefault("_compacted", []).append(i)
             elif msg_type == "tool_call":
-                input_str = json.dumps(msg["input"])
+                input_str = _dumps(msg["input"])
                 if len(input_str) > 120:
                     msg["input"] = {"_compacted": input_str[:120] + "..."}
                     msg["compacted"] = True
+                    session.setdefault("_compacted", []).append(i)
+    session["_compact_from"] = unsettled
 
 
 def readme():
@@ -251,6 +618,23 @@ def invoke_model(tools, session):
     return messages
 ```
 
+`aagent_loop` also accepts a coroutine function, so the async version only
+changes the client and awaits the call; the conversion and parsing stay the
+same:
+
+```python
+async_client = anthropic.AsyncAnthropic()
+
+async def invoke_model(tools, session):
+    ...  # convert session["messages"] as above
+    api_response = (await async_client.messages.create(**kwargs)).to_dict()
+    ...  # parse api_response as above
+    return messages
+```
+
+examples/anthropic_model.py has a complete async `invoke_model` that also
+streams responses and caches them.
+
 ## Hello World
 
 No tools, single turn -- the model just responds:
@@ -315,6 +699,12 @@ making any tool calls.
 A subagent is a tool handler that runs its own agent loop. The outer agent
 calls it like any tool and gets back a string result.
 
+The examples below are async: `invoke_model` is the async version from Setup,
+subagents are coroutine functions built on `aagent_loop`, and the coordinator
+runs under `asyncio.run(aagent_loop(...))`. Tool calls from one model response
+are awaited together with `asyncio.gather`, so parallel subagents overlap on a
+single event loop.
+
 ### Example: Text Compressor (compressor.py)
 
 A coordinator agent iteratively compresses text using two subagents:
@@ -322,18 +712,18 @@ a shortener and a quality judge.
 
 ```python
 # Subagent: compresses text
-def shorten(text):
+async def shorten(text):
     session = init_session(
         system_prompt="Rewrite the text to half its length. Output ONLY the result.",
         user_prompt=text,
     )
-    result = agent_loop(invoke_model, [], session, name="shortener", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="shortener", max_iterations=1)
     shortened = response(result)["content"]
     ratio = len(shortened) / len(text)
     return json.dumps({"compression_ratio": round(ratio, 3), "shortened_text": shortened})
 
 # Subagent: judges compression quality
-def judge(original, shortened):
+async def judge(original, shortened):
     session = init_session(
         system_prompt=(
             "Compare original and shortened text. Return ONLY JSON: "
@@ -342,52 +732,75 @@ def judge(original, shortened):
         ),
         user_prompt=f"ORIGINAL:\n{original}\n\nSHORTENED:\n{shortened}",
     )
-    result = agent_loop(invoke_model, [], session, name="judge", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="judge", max_iterations=1)
     return response(result)["content"]
 ```
 
 The coordinator has tools for `shorten` and `judge`, and its system prompt
 tells it to loop: shorten, judge, stop if too_lossy or diminishing returns,
 otherwise shorten again. Each subagent is a one-shot agent loop
-(max_iterations=1) with no tools of its own.
+(max_iterations=1) with no tools of its own. The judge only returns a
+verdict, so it runs on a smaller model by binding
+`functools.partial(invoke_model, model="claude-haiku-4-5")`. The coordinator's
+`shorten` handler checks for diminishing returns (ratio > 0.9) in Python and raises
+`FinalAnswer`, so the run ends without a coordinator turn spent deciding to
+stop.
+
+Because that procedure is fixed, `compress()` in the example runs the same
+loop in plain Python and calls the subagents directly, which saves a
+coordinator model call per step. It also shortens each candidate while the
+judge is still reviewing it, so a round costs one model round-trip instead
+of two. `coordinate()` keeps the model-driven version for comparison.
+
+For many documents, `compress_many(texts)` runs `compress()` on up to
+`max_concurrency` texts at once (default 10), so their requests overlap.
+With `use_batch_api=True` it runs the same loop through the Message Batches
+API instead. Each step is one batch covering every text that is still
+shrinking, which halves the cost at the price of batch latency.
+
+`compress_one_shot()` goes further and asks the model to run the whole
+shorten/self-judge loop within one response and return JSON. It falls back
+to `compress()` when that reply cannot be parsed.
 
 ### Example: Transform Rule Derivation (derive_transform.py)
 
-A more complex example with four subagents and a coordinator. Given a
+A more complex example with two subagents and a coordinator. Given a
 source text and target text, it derives general transformation rules and
 specific info that together reproduce the target from the source.
 
 ```python
 # Subagent: applies rules + specific info to source text
-def edit(text, rules, specific_info):
+async def edit(text, rules, specific_info):
     session = init_session(
         system_prompt="Apply the rules to the text using the specific info. Output ONLY the result.",
         user_prompt=f"SOURCE TEXT:\n{text}\n\nRULES:\n{rules}\n\nSPECIFIC INFO:\n{specific_info}",
     )
-    result = agent_loop(invoke_model, [], session, name="editor", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="editor", max_iterations=1)
     return response(result)["content"]
 
-# Subagent: scores how close the output is to the target
-def judge_similarity(editor_output, target):
+# Subagent: scores similarity to the target, generality of the rules, and
+# cleanliness of specific_info in a single model call
+async def judge_all(editor_output, target, rules, specific_info):
     session = init_session(
-        system_prompt='Compare texts. Return JSON: {"score": 0-100, "differences": "..."}',
-        user_prompt=f"EDITOR OUTPUT:\n{editor_output}\n\nTARGET:\n{target}",
+        system_prompt=(
+            "Score three criteria. Return JSON: "
+            '{"similarity": {"score": 0-100, ...}, "generality": {"score": 0-100, ...}, '
+            '"specific_info": {"score": 0-100, ...}}'
+        ),
+        user_prompt=(
+            f"EDITOR OUTPUT:\n{editor_output}\n\nTARGET:\n{target}\n\n"
+            f"RULES:\n{rules}\n\nSPECIFIC INFO:\n{specific_info}"
+        ),
     )
-    result = agent_loop(invoke_model, [], session, name="similarity-judge", max_iterations=1)
+    result = await aagent_loop(invoke_model, [], session, name="judge", max_iterations=1)
     return response(result)["content"]
-
-# Subagent: checks rules are abstract (no specific content leaked in)
-def judge_generality(rules):
-    ...
-
-# Subagent: checks specific_info is a flat fact list
-def judge_specific_info(specific_info):
-    ...
 ```
 
-The coordinator calls `edit`, then calls all three judges in parallel,
-refines based on scores, and repeats until all judges score above 90.
-Tool calls within a single model response execute in parallel automatically.
+The coordinator calls `edit`, then `judge_all`, refines based on the three
+scores, and repeats until all of them are above 90. Judging all three
+criteria in one call costs one round trip instead of three and sends the
+texts once. Tool calls within a single model response still execute in
+parallel automatically.
 
 ## API Reference
 
@@ -396,20 +809,28 @@ Tool calls within a single model response execute in parallel automatically.
 - `init_session(system_prompt, user_prompt)` - Create a new session
 - `extend_session(session, message)` - Append a message to the session
 - `send(session, user_message)` - Add a user message to the session
-- `fork_session(session)` - Deep copy a session for branching
+- `fork_session(session)` - Copy a session for branching (messages are copied, their strings shared)
 - `response(session)` - Get the last assistant message, or None
+- `messages_by_type(session, kind)` - Messages of one type (`"tool_result"`, ...) or role (`"user"`, ...), oldest first. Backed by an index that catches up with appended messages, so repeated lookups do not rescan the session; it is rebuilt if messages were removed or replaced
 
 ### Agent Loop
 
-- `agent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None, parallel=True)`
-  - `invoke_model(tools, session)` - Function that receives the session with generic messages, calls the model API, and returns a list of generic messages
+- `agent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None, parallel=True, dedupe=True)`
+  - `invoke_model(tools, session)` - Function that receives the session with generic messages, calls the model API, and returns a list of generic messages. It may also be a generator that yields messages as the model streams them; each tool call is then dispatched to the pool as soon as it is yielded
   - `tools` - List of Anthropic tool schemas ([] for no tools)
   - `session` - Session dict from init_session
   - `tool_handlers` - Dict mapping tool names to handler functions
   - `name` - Agent name for log output
   - `max_iterations` - Max model calls before stopping (None = unlimited)
-  - `parallel` - Execute tool calls in parallel via threads (default True). Set to False for sequential execution (useful in environments without thread support).
+  - `parallel` - Execute tool calls in parallel via threads (default True). Set to False for sequential execution (useful in environments without thread support). At most `AGENT_MAX_TOOL_PARALLELISM` (env var, default 8) top-level calls run at once on the shared pool. Tool calls made from inside a handler (a nested subagent) run on their own executors so they cannot deadlock the pool, so the limit does not cover them: each batch of nested sync calls gets up to the same number of threads again, and nested plain handlers under `aagent_loop` use the event loop's default executor.
+  - `dedupe` - Identical calls within one response (same name and input) run once, and each gets its own tool_result (default True). Set to False when a tool has side effects that must happen once per call
   - Returns the session with all messages appended
+- `aagent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None, dedupe=True)`
+  - Async counterpart of `agent_loop`. `invoke_model` and tool handlers may be coroutine functions; tool calls from one response run concurrently via `asyncio.gather`. Plain (sync) handlers run on the shared tool pool so they do not block the event loop
+  - `invoke_model` may also be an async generator that yields generic messages as the model streams them. Each tool call starts as soon as it is yielded, overlapping tool execution with the rest of the response
+- `aexecute_tool_calls(tool_calls, tool_handlers, dedupe=True)` - Run tool calls concurrently on the event loop, returning tool_result messages in call order
+- `FinalAnswer(content)` - Raise from a tool handler to end the loop: the tool_result is marked `"final": True` and `content` is appended as the assistant response without another model call
+- `register_tools(tool_handlers, tools)` - Bind handlers to their tool schemas: undeclared input keys are dropped and missing required keys produce a clear error. Both loops do this automatically
 
 ### Message Format
 
@@ -423,33 +844,127 @@ Messages use a generic format independent of any API:
     {"type": "tool_result", "id": "...", "output": "..."}
 
 Your `invoke_model` receives the raw session with these generic messages
-and must return a list of generic messages. All API-specific conversion
+and must return (or yield) a list of generic messages. All API-specific conversion
 happens inside `invoke_model`.
+
+Sessions only grow, so `invoke_model` does not need to convert every message
+on every call. The examples keep their converted API messages in
+`session["_api_cache"]`, together with the message count they cover, and
+convert only the messages appended since the last call. `compact_session`
+rewrites older tool results in place and appends their indices to
+`session["_compacted"]`, so a cache can rebuild just those blocks.
+`fork_session` drops both keys, and a fork builds its own cache.
 """
 
 
-def agent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None, parallel=True):
-    if tool_handlers is None:
-        tool_handlers = {}
+def _finish(session, results, name):
+    """If a handler raised FinalAnswer, append its content as the response."""
+    final = next((r for r in results if r.get("final")), None)
+    if final is None:
+        return False
+    output = final["output"]
+    msg = {"role": "assistant", "content": output if isinstance(output, str) else _dumps(output), "ts": now()}
+    extend_session(session, msg)
+    log(msg, name)
+    return True
+
+
+def agent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None, parallel=True,
+               dedupe=True):
+    tool_handlers = register_tools(tool_handlers or {}, tools)
+
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        iteration += 1
+
+        # invoke_model may return a list or be a generator that yields messages as
+        # the model streams them; either way each tool call is submitted as soon
+        # as it arrives, so it runs while the rest of the response is decoded.
+        # A repeat of an earlier call in the same response reuses its result,
+        # unless dedupe=False.
+        tool_calls, keys, pending = [], [], {}
+        with _tool_executor() if parallel else contextlib.nullcontext() as executor:
+            try:
+                for msg in invoke_model(tools, session):
+                    extend_session(session, msg)
+                    log(msg, name)
+                    if msg.get("type") == "tool_call":
+                        tool_calls.append(msg)
+                        if parallel:
+                            key = _call_key(msg, dedupe)
+                            keys.append(key)
+                            if key not in pending:
+                                pending[key] = executor.submit(_tool_result, msg, tool_handlers)
+            except BaseException:
+                for future in pending.values():
+                    future.cancel()
+                raise
+
+            compact_session(session)
+
+            if not tool_calls:
+                break
+
+            if parallel:
+                results = [_result_for(pending[key].result(), tc) for key, tc in zip(keys, tool_calls)]
+            else:
+                results = execute_tool_calls(tool_calls, tool_handlers, parallel=False, dedupe=dedupe)
+
+        for result in results:
+            extend_session(session, result)
+            log(result, name)
+
+        if _finish(session, results, name):
+            break
+
+    return session
+
+
+async def aagent_loop(invoke_model, tools, session, tool_handlers=None, name=None, max_iterations=None,
+                      dedupe=True):
+    """Async counterpart of agent_loop.
+
+    invoke_model may be a coroutine function (e.g. one using anthropic.AsyncAnthropic)
+    or an async generator that yields messages as the model streams them. Each tool
+    call starts as soon as it is received, so with a streaming invoke_model tools
+    run while the rest of the response is still arriving. Tool calls from a single
+    response run concurrently, and identical ones (same name and input) run once
+    unless dedupe=False.
+    """
+    tool_handlers = register_tools(tool_handlers or {}, tools)
 
     iteration = 0
     while max_iterations is None or iteration < max_iterations:
         iteration += 1
 
-        messages = invoke_model(tools, session)
-        for msg in messages:
-            extend_session(session, msg)
-            log(msg, name)
+        tool_calls, keys, pending = [], [], {}
+        try:
+            async for msg in _aiter_messages(invoke_model(tools, session)):
+                extend_session(session, msg)
+                log(msg, name)
+                if msg.get("type") == "tool_call":
+                    key = _call_key(msg, dedupe)
+                    tool_calls.append(msg)
+                    keys.append(key)
+                    if key not in pending:
+                        pending[key] = asyncio.ensure_future(_atool_result(msg, tool_handlers))
+        except BaseException:
+            for task in pending.values():
+                task.cancel()
+            raise
 
         compact_session(session)
 
-        tool_calls = [m for m in messages if m.get("type") == "tool_call"]
-        if not tool_calls:
+        if not pending:
             break
 
-        results = execute_tool_calls(tool_calls, tool_handlers, parallel=parallel)
+        await asyncio.gather(*pending.values())
+        results = [_result_for(pending[key].result(), tc) for key, tc in zip(keys, tool_calls)]
         for result in results:
             extend_session(session, result)
             log(result, name)
 
+        if _finish(session, results, name):
+            break
+
     return session
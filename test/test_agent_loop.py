@@ -1,6 +1,13 @@
+from datetime import datetime, timezone
 from simple_agent_loop import *
+import simple_agent_loop
+import asyncio
+import copy
 import json
 import pytest
+import re
+import threading
+import time
 
 
 TOOLS = [
@@ -26,19 +33,18 @@ def make_invoke_model():
     def invoke_model(tools, session):
         nonlocal call_count
         call_count += 1
-        messages = session["messages"]
-
         if call_count == 1:
-            if not any(m.get("role") == "user" for m in messages):
+            if not messages_by_type(session, "user"):
                 raise ValueError("Expected a user message on first call")
             return [
                 {"type": "thinking", "content": "I need to add these two numbers.", "signature": "sig_abc123"},
                 {"type": "tool_call", "name": "add", "id": "call_001", "input": {"a": 98765432101234, "b": 12345678909876}},
             ]
         elif call_count == 2:
-            if not any(m.get("type") == "tool_result" for m in messages):
+            tool_results = messages_by_type(session, "tool_result")
+            if not tool_results:
                 raise ValueError("Expected a tool_result on second call")
-            tool_result = next(m for m in messages if m.get("type") == "tool_result")
+            tool_result = tool_results[-1]
             result_value = json.loads(tool_result["output"])["result"]
             return [
                 {"role": "assistant", "content": f"The answer is {result_value}.", "ts": now()},
@@ -148,3 +154,461 @@ class TestAgentLoop:
         result = agent_loop(invoke_always_tool, TOOLS, session, tool_handlers={"add": add}, max_iterations=3)
         tool_calls = [m for m in result["messages"] if m.get("type") == "tool_call"]
         assert len(tool_calls) == 3
+
+    def test_final_answer_ends_loop(self):
+        """A handler raising FinalAnswer ends the loop without another model call."""
+        calls = 0
+
+        def invoke_model(tools, session):
+            nonlocal calls
+            calls += 1
+            return [{"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": 1, "b": 2}}]
+
+        def finish(a, b):
+            raise FinalAnswer(f"{a + b}, done")
+
+        for parallel in (True, False):
+            calls = 0
+            session = {"messages": [{"role": "user", "content": "Add"}]}
+            result = agent_loop(invoke_model, TOOLS, session, tool_handlers={"add": finish}, parallel=parallel)
+            assert calls == 1
+            assert result["messages"][-2]["final"] is True
+            assert response(result)["content"] == "3, done"
+
+        async def afinish(a, b):
+            raise FinalAnswer("async done")
+
+        session = {"messages": [{"role": "user", "content": "Add"}]}
+        result = asyncio.run(aagent_loop(invoke_model, TOOLS, session, tool_handlers={"add": afinish}))
+        assert response(result)["content"] == "async done"
+
+
+class TestAsyncAgentLoop:
+    def test_async_tool_call_and_response(self):
+        """aagent_loop accepts an async invoke_model and async tool handlers."""
+        sync_invoke = make_invoke_model()
+
+        async def invoke_model(tools, session):
+            return sync_invoke(tools, session)
+
+        async def add_async(a, b):
+            return add(a, b)
+
+        session = {
+            "messages": [
+                {"role": "user", "content": "What is 98765432101234 + 12345678909876?"}
+            ]
+        }
+        result = asyncio.run(aagent_loop(invoke_model, TOOLS, session, tool_handlers={"add": add_async}))
+        final = response(result)
+        assert final is not None
+        assert "111111111011110" in final["content"]
+
+    def test_tool_calls_run_concurrently(self):
+        """Handlers from one response overlap: each waits for the other to start."""
+        async def run():
+            first_started = asyncio.Event()
+            second_started = asyncio.Event()
+
+            async def first():
+                first_started.set()
+                await asyncio.wait_for(second_started.wait(), timeout=1)
+                return "first"
+
+            async def second():
+                second_started.set()
+                await asyncio.wait_for(first_started.wait(), timeout=1)
+                return "second"
+
+            tool_calls = [
+                {"type": "tool_call", "name": "first", "id": "call_1", "input": {}},
+                {"type": "tool_call", "name": "second", "id": "call_2", "input": {}},
+            ]
+            return await aexecute_tool_calls(tool_calls, {"first": first, "second": second})
+
+        results = asyncio.run(run())
+        assert [r["output"] for r in results] == ["first", "second"]
+
+    def test_streamed_tool_calls_start_before_response_ends(self):
+        """With an async generator invoke_model, a tool call runs while the rest of the response streams."""
+        tool_started = asyncio.Event()
+        call_count = 0
+
+        async def invoke_model(tools, session):
+            nonlocal call_count
+            call_count += 1
+            if call_count == 1:
+                yield {"type": "tool_call", "name": "first", "id": "call_1", "input": {}}
+                await asyncio.wait_for(tool_started.wait(), timeout=1)
+                yield {"type": "tool_call", "name": "add", "id": "call_2", "input": {"a": 1, "b": 2}}
+            else:
+                yield {"role": "assistant", "content": "Done.", "ts": now()}
+
+        async def first():
+            tool_started.set()
+            return "started"
+
+        session = {"messages": [{"role": "user", "content": "Go"}]}
+        result = asyncio.run(aagent_loop(invoke_model, TOOLS, session, tool_handlers={"first": first, "add": add}))
+        outputs = [m["output"] for m in result["messages"] if m.get("type") == "tool_result"]
+        assert outputs == ["started", json.dumps({"result": 3})]
+        assert response(result)["content"] == "Done."
+
+    def test_sync_handlers_run_concurrently(self):
+        """Plain handlers run on the tool pool, so they don't serialize on the event loop."""
+        barrier = threading.Barrier(2, timeout=1)
+
+        def meet(who):
+            barrier.wait()
+            return f"met {who}"
+
+        tool_calls = [
+            {"type": "tool_call", "name": "meet", "id": "call_1", "input": {"who": "a"}},
+            {"type": "tool_call", "name": "meet", "id": "call_2", "input": {"who": "b"}},
+        ]
+        results = asyncio.run(aexecute_tool_calls(tool_calls, {"meet": meet}))
+        assert [r["output"] for r in results] == ["met a", "met b"]
+
+    def test_errors_become_tool_results(self):
+        """Exceptions and unknown tools are reported as tool_result errors, not raised."""
+        async def boom():
+            raise RuntimeError("boom")
+
+        tool_calls = [
+            {"type": "tool_call", "name": "boom", "id": "call_1", "input": {}},
+            {"type": "tool_call", "name": "missing", "id": "call_2", "input": {}},
+        ]
+        results = asyncio.run(aexecute_tool_calls(tool_calls, {"boom": boom}))
+        assert results[0] == {"type": "tool_result", "id": "call_1", "output": "Error: boom"}
+        assert results[1]["output"] == "Error: unknown tool 'missing'"
+
+
+class TestForkSession:
+    def test_fork_is_independent(self):
+        """Extending or compacting a fork leaves the original session untouched."""
+        session = init_session("You are helpful.", "Hi")
+        extend_session(session, {"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": 1, "b": 2}})
+        forked = fork_session(session)
+
+        send(forked, "Another question")
+        forked["messages"][2]["input"]["a"] = 100
+        forked["messages"][1]["content"] = "Changed"
+
+        assert len(session["messages"]) == 3
+        assert session["messages"][1]["content"] == "Hi"
+        assert session["messages"][2]["input"] == {"a": 1, "b": 2}
+
+    def test_fork_shares_strings(self):
+        """Immutable leaves are aliased rather than copied."""
+        session = init_session("You are helpful.", "x" * 10000)
+        forked = fork_session(session)
+        assert forked["messages"][1]["content"] is session["messages"][1]["content"]
+
+    def test_fork_drops_derived_state(self):
+        """Caches derived from the messages are rebuilt by the fork, not shared."""
+        session = init_session("You are helpful.", "Hi")
+        session["_api_cache"] = {"len": 2}
+        session["_compacted"] = [1]
+        forked = fork_session(session)
+        assert "_api_cache" not in forked
+        assert "_compacted" not in forked
+
+
+class TestCompactSession:
+    def test_compacted_messages_are_logged(self):
+        """Messages rewritten in place are recorded by index in session["_compacted"]."""
+        session = init_session("You are helpful.", "Hi")
+        extend_session(session, {"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": "x" * 200}})
+        extend_session(session, {"type": "tool_result", "id": "call_1", "output": "ok"})
+        extend_session(session, {"role": "assistant", "content": "First"})
+        extend_session(session, {"role": "assistant", "content": "Second"})
+        compact_session(session)
+        compact_session(session)
+        assert session["_compacted"] == [2]
+        assert session["messages"][2]["compacted"]
+
+    def test_incremental_matches_full_pass(self):
+        """Compacting after every message gives the same result as one pass at the end."""
+        turn = [
+            {"type": "thinking", "content": "t" * 200},
+            {"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": "x" * 200}},
+            {"type": "tool_result", "id": "call_1", "output": json.dumps({"score": 7, "notes": "n" * 200})},
+            {"type": "thinking", "content": "short"},
+            {"role": "assistant", "content": "Done"},
+        ]
+        incremental = init_session("You are helpful.", "Hi")
+        for _ in range(6):
+            for msg in copy.deepcopy(turn):
+                extend_session(incremental, msg)
+                compact_session(incremental)
+        assert incremental["_compact_from"] > 0
+
+        full = init_session("You are helpful.", "Hi")
+        for _ in range(6):
+            full["messages"].extend(copy.deepcopy(turn))
+        compact_session(full)
+        assert incremental["messages"] == full["messages"]
+        assert incremental["_history_full"] == full["_history_full"]
+
+
+class TestToolExecution:
+    def test_identical_calls_run_once(self):
+        """Repeated (name, input) calls in one turn run once and each gets its own tool_result."""
+        calls = []
+
+        def counted_add(a, b):
+            calls.append((a, b))
+            return add(a, b)
+
+        tool_calls = [
+            {"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": 1, "b": 2}},
+            {"type": "tool_call", "name": "add", "id": "call_2", "input": {"b": 2, "a": 1}},
+            {"type": "tool_call", "name": "add", "id": "call_3", "input": {"a": 2, "b": 2}},
+        ]
+        for run in (
+            lambda: execute_tool_calls(tool_calls, {"add": counted_add}),
+            lambda: execute_tool_calls(tool_calls, {"add": counted_add}, parallel=False),
+            lambda: asyncio.run(aexecute_tool_calls(tool_calls, {"add": counted_add})),
+        ):
+            calls.clear()
+            results = run()
+            assert sorted(calls) == [(1, 2), (2, 2)]
+            assert [r["id"] for r in results] == ["call_1", "call_2", "call_3"]
+            assert results[0]["output"] == results[1]["output"] == json.dumps({"result": 3})
+
+        calls.clear()
+        execute_tool_calls(tool_calls, {"add": counted_add}, dedupe=False)
+        assert len(calls) == 3
+
+    def test_unserializable_inputs_never_deduped(self):
+        """Inputs that aren't JSON are not compared by repr, so equal-looking calls all run."""
+        class Opaque:
+            def __init__(self, value):
+                self.value = value
+
+            def __repr__(self):
+                return "Opaque()"
+
+        def unwrap(x):
+            return str(x.value)
+
+        tool_calls = [
+            {"type": "tool_call", "name": "unwrap", "id": f"call_{i}", "input": {"x": Opaque(i)}}
+            for i in range(2)
+        ]
+        results = execute_tool_calls(tool_calls, {"unwrap": unwrap})
+        assert [r["output"] for r in results] == ["0", "1"]
+
+    def test_streamed_tool_calls_start_before_response_ends(self):
+        """With a generator invoke_model, agent_loop runs each tool call as soon as it is yielded."""
+        tool_started = threading.Event()
+        call_count = 0
+
+        def invoke_model(tools, session):
+            nonlocal call_count
+            call_count += 1
+            if call_count == 1:
+                yield {"type": "tool_call", "name": "first", "id": "call_1", "input": {}}
+                assert tool_started.wait(timeout=1)
+                yield {"type": "tool_call", "name": "add", "id": "call_2", "input": {"a": 1, "b": 2}}
+            else:
+                yield {"role": "assistant", "content": "Done.", "ts": now()}
+
+        def first():
+            tool_started.set()
+            return "started"
+
+        session = {"messages": [{"role": "user", "content": "Go"}]}
+        result = agent_loop(invoke_model, TOOLS, session, tool_handlers={"first": first, "add": add})
+        outputs = [m["output"] for m in result["messages"] if m.get("type") == "tool_result"]
+        assert outputs == ["started", json.dumps({"result": 3})]
+        assert response(result)["content"] == "Done."
+
+    def test_parallel_calls_reuse_shared_pool(self):
+        """Parallel tool calls run on the shared, persistent tool pool."""
+        def thread_name(i):
+            return threading.current_thread().name
+
+        tool_calls = [{"type": "tool_call", "name": "where", "id": f"call_{i}", "input": {"i": i}} for i in range(3)]
+        first = execute_tool_calls(tool_calls, {"where": thread_name})
+        second = execute_tool_calls(tool_calls, {"where": thread_name})
+        names = {r["output"] for r in first + second}
+        assert all(name.startswith("tool") for name in names)
+
+    def test_nested_subagents_do_not_deadlock(self):
+        """A tool handler that runs its own tool-using agent loop completes, even when nested deeply."""
+        def subagent(depth, i=0):
+            if depth == 0:
+                return "leaf"
+            calls = [
+                {"type": "tool_call", "name": "subagent", "id": f"call_{i}", "input": {"depth": depth - 1, "i": i}}
+                for i in range(20)
+            ]
+            results = execute_tool_calls(calls, {"subagent": subagent})
+            return results[0]["output"]
+
+        assert subagent(3) == "leaf"
+
+    def test_parallel_results_follow_call_order(self):
+        """Results come back in tool_call order even when later calls finish first."""
+        def slow(delay):
+            time.sleep(delay)
+            return str(delay)
+
+        tool_calls = [
+            {"type": "tool_call", "name": "slow", "id": f"call_{i}", "input": {"delay": d}}
+            for i, d in enumerate([0.05, 0.0, 0.02])
+        ]
+        results = execute_tool_calls(tool_calls, {"slow": slow})
+        assert [r["id"] for r in results] == ["call_0", "call_1", "call_2"]
+        assert [r["output"] for r in results] == ["0.05", "0.0", "0.02"]
+
+    def test_old_judge_results_reduced_to_scores(self):
+        """Past the threshold, judge-style tool results older than two model turns keep only their scores."""
+        session = init_session("You are helpful.", "Judge this")
+        verdict = json.dumps({"score": 42, "differences": "x" * 500})
+        for i in range(COMPACT_THRESHOLD):
+            extend_session(session, {"type": "tool_call", "name": "judge", "id": f"call_{i}", "input": {}})
+            extend_session(session, {"type": "tool_result", "id": f"call_{i}", "output": verdict})
+        compact_session(session)
+
+        results = [m for m in session["messages"] if m.get("type") == "tool_result"]
+        assert json.loads(results[0]["output"]) == {"score": 42}
+        assert session["_history_full"][3] == verdict
+        # The results of the last two model turns are left alone.
+        assert results[-1]["output"] == verdict
+        assert results[-2]["output"] == verdict
+        assert json.loads(results[-3]["output"]) == {"score": 42}
+
+    def test_wide_integer_scores_kept_exact(self):
+        """Scores wider than 64 bits survive compaction unchanged."""
+        session = init_session("You are helpful.", "Judge this")
+        verdict = json.dumps({"score": 2 ** 70 + 1, "differences": "x" * 500})
+        for i in range(COMPACT_THRESHOLD):
+            extend_session(session, {"type": "tool_call", "name": "judge", "id": f"call_{i}", "input": {}})
+            extend_session(session, {"type": "tool_result", "id": f"call_{i}", "output": verdict})
+        compact_session(session)
+
+        results = [m for m in session["messages"] if m.get("type") == "tool_result"]
+        assert json.loads(results[0]["output"]) == {"score": 2 ** 70 + 1}
+
+    def test_nested_judge_results_and_plain_outputs(self):
+        """Per-criterion scores are kept; non-judge tool results are never touched."""
+        session = init_session("You are helpful.", "Judge this")
+        nested = json.dumps({
+            "similarity": {"score": 80, "differences": "d" * 200},
+            "generality": {"score": 95, "issues": "none"},
+        })
+        plain = "p" * 500
+        for i in range(COMPACT_THRESHOLD):
+            extend_session(session, {"type": "tool_call", "name": "judge", "id": f"call_{i}", "input": {}})
+            extend_session(session, {"type": "tool_result", "id": f"call_{i}", "output": nested if i % 2 else plain})
+        compact_session(session)
+
+        results = [m for m in session["messages"] if m.get("type") == "tool_result"]
+        assert results[0]["output"] == plain
+        assert json.loads(results[1]["output"]) == {"similarity": {"score": 80}, "generality": {"score": 95}}
+
+
+class TestResponse:
+    def test_tracks_last_assistant_message(self):
+        """response() returns the latest assistant message appended through extend_session."""
+        session = init_session("You are helpful.", "Hi")
+        assert response(session) is None
+        extend_session(session, {"role": "assistant", "content": "First"})
+        extend_session(session, {"type": "tool_call", "name": "add", "id": "call_1", "input": {}})
+        assert response(session)["content"] == "First"
+        extend_session(session, {"role": "assistant", "content": "Second"})
+        assert response(session)["content"] == "Second"
+        assert response(fork_session(session))["content"] == "Second"
+
+    def test_hand_built_session(self):
+        """Sessions whose messages were not added via extend_session are still scanned."""
+        session = {"messages": [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]}
+        assert response(session)["content"] == "Hello"
+
+    def test_direct_appends_and_removals(self):
+        """response() sees assistant messages appended directly and survives removed messages."""
+        session = init_session("You are helpful.", "Hi")
+        extend_session(session, {"role": "assistant", "content": "First"})
+        session["messages"].append({"role": "assistant", "content": "Second"})
+        assert response(session)["content"] == "Second"
+        del session["messages"][2:]
+        assert response(session) is None
+
+    def test_messages_by_type(self):
+        """messages_by_type picks up appended messages and is not shared with forks."""
+        session = init_session("You are helpful.", "Hi")
+        assert messages_by_type(session, "tool_result") == []
+        extend_session(session, {"type": "tool_result", "id": "call_1", "output": "a"})
+        session["messages"].append({"type": "tool_result", "id": "call_2", "output": "b"})
+        assert [m["output"] for m in messages_by_type(session, "tool_result")] == ["a", "b"]
+        assert messages_by_type(session, "user")[0]["content"] == "Hi"
+
+        forked = fork_session(session)
+        extend_session(forked, {"type": "tool_result", "id": "call_3", "output": "c"})
+        assert len(messages_by_type(forked, "tool_result")) == 3
+        assert len(messages_by_type(session, "tool_result")) == 2
+
+    def test_messages_by_type_after_truncation(self):
+        """The index is rebuilt when messages were removed, even if appends refill the session."""
+        session = init_session("You are helpful.", "Hi")
+        for i in range(3):
+            extend_session(session, {"type": "tool_result", "id": f"call_{i}", "output": str(i)})
+        assert len(messages_by_type(session, "tool_result")) == 3
+
+        del session["messages"][3:]
+        assert [m["output"] for m in messages_by_type(session, "tool_result")] == ["0"]
+
+        del session["messages"][2:]
+        extend_session(session, {"role": "assistant", "content": "Done"})
+        extend_session(session, {"type": "tool_result", "id": "call_9", "output": "9"})
+        extend_session(session, {"role": "user", "content": "Again"})
+        extend_session(session, {"type": "tool_result", "id": "call_10", "output": "10"})
+        assert [m["output"] for m in messages_by_type(session, "tool_result")] == ["9", "10"]
+        assert [m["content"] for m in messages_by_type(session, "user")] == ["Hi", "Again"]
+
+        session["messages"][-1] = {"role": "user", "content": "Replaced"}
+        assert [m["output"] for m in messages_by_type(session, "tool_result")] == ["9"]
+
+
+class TestNow:
+    def test_iso_8601_utc(self):
+        """now() returns an ISO 8601 UTC timestamp matching the current time."""
+        ts = now()
+        assert re.fullmatch(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z", ts)
+        parsed = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+        assert abs((datetime.now(timezone.utc) - parsed).total_seconds()) < 2
+
+    def test_formats_each_second_once(self, monkeypatch):
+        """Calls within the same second reuse the formatted string; a new second reformats."""
+        clock = [1771032000.2]
+        monkeypatch.setattr(simple_agent_loop.time, "time", lambda: clock[0])
+        first = now()
+        clock[0] = 1771032000.9
+        assert now() is first
+        clock[0] = 1771032001.0
+        assert now() == "2026-02-14T01:20:01Z"
+        assert first == "2026-02-14T01:20:00Z"
+
+
+class TestRegisterTools:
+    def test_drops_undeclared_keys(self):
+        """Keys the model invents that aren't in the schema never reach the handler."""
+        handlers = register_tools({"add": add}, TOOLS)
+        assert json.loads(handlers["add"](a=1, b=2, c=3))["result"] == 3
+
+    def test_missing_required_key(self):
+        """A missing required key becomes a descriptive error tool_result."""
+        tool_calls = [{"type": "tool_call", "name": "add", "id": "call_1", "input": {"a": 1}}]
+        results = execute_tool_calls(tool_calls, register_tools({"add": add}, TOOLS))
+        assert results[0]["output"] == "Error: tool 'add' is missing required input: b"
+
+    def test_async_handlers_stay_async(self):
+        """Coroutine handlers are still awaited after registration."""
+        async def add_async(a, b):
+            return add(a, b)
+
+        handlers = register_tools({"add": add_async}, TOOLS)
+        assert json.loads(asyncio.run(handlers["add"](a=1, b=2)))["result"] == 3
+
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import pytest
+import sys
+
+pytest.importorskip("orjson")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "examples"))
+from llm_cache import LLMCache, NearDuplicateCache, memoize
+
+
+REPORT = " ".join(f"word{i}" for i in range(150)) + " Total revenue was {} million. " + " ".join(
+    f"tail{i}" for i in range(150)
+)
+
+
+class TestMemoize:
+    def test_repeat_calls_share_one_call(self):
+        """Concurrent and later calls with the same arguments reuse one result."""
+        calls = 0
+
+        @memoize()
+        async def double(x):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        async def run():
+            first = await asyncio.gather(double(2), double(2), double(3))
+            return first, await double(2)
+
+        assert asyncio.run(run()) == ([4, 4, 6], 4)
+        assert calls == 2
+
+    def test_failed_calls_are_evicted(self):
+        """A call that raised is retried rather than served again."""
+        calls = 0
+
+        @memoize()
+        async def flaky():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise RuntimeError("boom")
+            return "ok"
+
+        async def run():
+            with pytest.raises(RuntimeError):
+                await flaky()
+            return await flaky()
+
+        assert asyncio.run(run()) == "ok"
+        assert calls == 2
+
+    def test_store_outlives_the_task_cache(self, tmp_path):
+        """With a store, results survive cache_clear and a new store on the same path."""
+        calls = 0
+
+        async def shout(text):
+            nonlocal calls
+            calls += 1
+            return text.upper()
+
+        first = memoize(store=LLMCache(path=str(tmp_path / "cache.db")), salt="v1")(shout)
+        assert asyncio.run(first("hi")) == "HI"
+        first.cache_clear()
+        second = memoize(store=LLMCache(path=str(tmp_path / "cache.db")), salt="v1")(shout)
+        assert asyncio.run(second("hi")) == "HI"
+        assert calls == 1
+
+        # A different salt (e.g. an edited prompt) misses.
+        third = memoize(store=LLMCache(path=str(tmp_path / "cache.db")), salt="v2")(shout)
+        asyncio.run(third("hi"))
+        assert calls == 2
+
+
+class TestNearDuplicateCache:
+    def test_near_identical_text_matches(self):
+        """A text with one word changed gets the stored value."""
+        cache = NearDuplicateCache()
+        text = REPORT.format("4.2")
+        cache.put(cache.key(text), "summary")
+        assert cache.get(cache.key(text.replace("word75", "term75"))) == "summary"
+        assert cache.get(cache.key("something else entirely")) is None
+
+    def test_texts_differing_in_a_number_do_not_match(self):
+        """Changing a figure keeps the texts similar but must not share the result."""
+        cache = NearDuplicateCache()
+        cache.put(cache.key(REPORT.format("4.2")), "revenue was 4.2 million")
+        assert cache.get(cache.key(REPORT.format("9.7"))) is None
+        assert cache.get(cache.key(REPORT.format("4.2"))) == "revenue was 4.2 million"
+
+    def test_least_recently_used_evicted(self):
+        """Past maxsize the least recently used entry is dropped."""
+        cache = NearDuplicateCache(maxsize=2)
+        keys = [cache.key(f"text number {n} " + REPORT.format(n)) for n in range(3)]
+        cache.put(keys[0], 0)
+        cache.put(keys[1], 1)
+        assert cache.get(keys[0]) == 0
+        cache.put(keys[2], 2)
+        assert cache.get(keys[1]) is None
+        assert [cache.get(keys[0]), cache.get(keys[2])] == [0, 2]